@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import stats
+
+MINUTE = 60
+DAY = 24 * 60 * MINUTE
+
+# First match wins. Structural metadata changes rarely, anything carrying signed media URLs expires quickly.
+API_CACHE_TTLS = [
+    (re.compile(r"/c27/online_courseware/xty/kls/pub_news/"), 7 * DAY),
+    (re.compile(r"/mooc-api/v1/lms/learn/leaf_info/"), 7 * DAY),
+    (re.compile(r"/api/v3/lesson-summary/replay"), 30 * MINUTE),
+    (re.compile(r"/v/lesson/get_lesson_replay_timeline/"), 30 * MINUTE),
+    # Deck lists grow when teachers upload slides after class
+    (re.compile(r"/api/v3/lesson-summary/student\?"), 30 * MINUTE),
+    (re.compile(r"/v2/api/web/lessonafter/\d+/presentation"), 30 * MINUTE),
+    (re.compile(r"/api/v3/lesson-summary/student/presentation"), 30 * MINUTE),
+    (re.compile(r"/v2/api/web/lessonafter/presentation/"), 30 * MINUTE),
+    (re.compile(r"/v2/api/web/cards/detlist/"), 30 * MINUTE),
+    (re.compile(r"/api/open/audiovideo/playurl"), 10 * MINUTE),
+]
+
+
+class CachedResponse:
+    status_code = 200
+
+    def __init__(self, url: str, text: str):
+        self.url = url
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        pass
+
+
+class CachedSession:
+    """Wraps a requests session so that `get` on known metadata endpoints is served from disk.
+
+    Entries live in `folder` as one JSON file each, keyed by user identity and URL, and are
+    evicted least-recently-used once the folder grows beyond `max_bytes`. Only responses
+    accepted by `is_valid` are stored. Everything else is passed through to the session.
+    `identity` should stay the same across logins of a user (e.g. the user id), so entries
+    outlive the session; without it the session cookie is used.
+    """
+
+    def __init__(self, session, folder: str, max_bytes: int = 64 * 1024 * 1024, is_valid=None, identity=None):
+        self.session = session
+        self.identity = identity
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.is_valid = is_valid or (lambda payload: True)
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> (size, last used)
+
+        os.makedirs(folder, exist_ok=True)
+        for name in os.listdir(folder):
+            if name.endswith(".json"):
+                path = os.path.join(folder, name)
+                self.entries[name[:-5]] = (os.path.getsize(path), os.path.getmtime(path))
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    @staticmethod
+    def ttl_for(url: str):
+        for pattern, ttl in API_CACHE_TTLS:
+            if pattern.search(url):
+                return ttl
+
+        return None
+
+    def _key(self, url: str, headers) -> str:
+        identity = self.identity or self.session.cookies.get('sessionid')
+        material = json.dumps([identity, url, sorted((headers or {}).items())])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, url: str, **kwargs):
+        ttl = self.ttl_for(url)
+        if ttl is None:
+            return self.session.get(url, **kwargs)
+
+        key = self._key(url, kwargs.get('headers'))
+        path = os.path.join(self.folder, key + ".json")
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is not None and entry['expires'] > time.time():
+            stats.incr("API cache", "hits")
+            with self.lock:
+                self.entries[key] = (self.entries.get(key, (0, 0))[0], time.time())
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return CachedResponse(url, entry['body'])
+
+        stats.incr("API cache", "expired" if entry is not None else "misses")
+
+        response = self.session.get(url, **kwargs)
+        if response.status_code == 200:
+            try:
+                payload = response.json()
+            except ValueError:
+                payload = None
+
+            if payload is not None and self.is_valid(payload):
+                self._store(key, path, {'url': url, 'expires': time.time() + ttl, 'body': response.text})
+
+        return response
+
+    def _store(self, key: str, path: str, entry: dict):
+        data = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.entries[key] = (len(data), time.time())
+            self._evict()
+
+    def _evict(self):
+        total = sum(size for size, _ in self.entries.values())
+        if total <= self.max_bytes:
+            return
+
+        for key, (size, _) in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(os.path.join(self.folder, key + ".json"))
+            except OSError:
+                pass
+
+            del self.entries[key]
+            total -= size
+            stats.incr("API cache", "evictions")
@@ -0,0 +1,205 @@
+import atexit
+import json
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future
+
+STATUS_KEYS = ["gid", "status", "totalLength", "completedLength", "downloadSpeed", "errorCode", "errorMessage"]
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Aria2RPC:
+    """A single long-lived `aria2c --enable-rpc` process shared by every download.
+
+    `submit` queues a URL and returns a future resolved with the final aria2 status once the
+    download completes or fails. One poller thread checks all active downloads per round
+    with a single `system.multicall`.
+    """
+
+    def __init__(self, aria2c_path: str = "aria2c", max_concurrent: int = 16, poll_interval: float = 0.5,
+                 progress_interval: float = 5.0):
+        self.aria2c_path = aria2c_path
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.port = None
+        self.secret = secrets.token_hex(16)
+        self.process = None
+        self.lock = threading.Lock()
+        self.active = {}  # gid -> (future, label)
+        self.poller = None
+        self.running = False
+
+    def start(self):
+        self.port = _free_port()
+        self.process = subprocess.Popen(
+            [self.aria2c_path, "--enable-rpc", f"--rpc-listen-port={self.port}", "--rpc-listen-all=false",
+             f"--rpc-secret={self.secret}", f"--max-concurrent-downloads={self.max_concurrent}",
+             "--auto-file-renaming=false", "-c", "-l", "aria2c_rpc.log", "--log-level", "warn"],
+            stdout=subprocess.DEVNULL)
+
+        for _ in range(100):
+            try:
+                self.call("aria2.getVersion")
+                break
+            except OSError:
+                if self.process.poll() is not None:
+                    raise RuntimeError(f"aria2c exited with code {self.process.returncode}")
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("aria2c RPC server did not come up")
+
+        self.running = True
+        self.poller = threading.Thread(target=self._poll, name="aria2-rpc-poller", daemon=True)
+        self.poller.start()
+        atexit.register(self.shutdown)
+        return self
+
+    def call(self, method: str, *params):
+        # system.* methods don't take a token, the calls inside a multicall carry their own
+        if not method.startswith("system."):
+            params = (f"token:{self.secret}", *params)
+
+        payload = json.dumps({"jsonrpc": "2.0", "id": "rc", "method": method,
+                              "params": list(params)}).encode("utf-8")
+        request = urllib.request.Request(f"http://127.0.0.1:{self.port}/jsonrpc", data=payload,
+                                         headers={"Content-Type": "application/json"})
+
+        with urllib.request.urlopen(request, timeout=30) as response:
+            result = json.load(response)
+
+        if "error" in result:
+            raise RuntimeError(f"aria2 {method} failed: {result['error']}")
+
+        return result["result"]
+
+    def submit(self, url: str, out_path: str, label: str = "") -> Future:
+        options = {
+            "dir": os.path.abspath(os.path.dirname(out_path) or "."),
+            "out": os.path.basename(out_path),
+            "split": "16",
+            "max-connection-per-server": "16",
+            "min-split-size": "1M",
+            "stream-piece-selector": "random",
+        }
+
+        future = Future()
+        with self.lock:
+            if not self.running:
+                raise RuntimeError("aria2c RPC server is not running")
+
+            gid = self.call("aria2.addUri", [url], options)
+            self.active[gid] = (future, label or out_path)
+
+        return future
+
+    def download(self, items: list, label: str = "") -> list:
+        """Download `(url, out_path)` pairs and return the paths that failed"""
+        futures = [(path, self.submit(url, path, f"{label} - {os.path.basename(path)}" if label else path))
+                   for url, path in items]
+
+        failed = []
+        for path, future in futures:
+            status = future.result()
+            if status["status"] != "complete":
+                print(f"aria2c failed to download {path}: {status.get('errorMessage', status['status'])}",
+                      file=sys.stderr)
+                failed.append(path)
+
+        return failed
+
+    def _poll(self):
+        last_progress = time.monotonic()
+
+        while self.running:
+            time.sleep(self.poll_interval)
+
+            if self.process.poll() is not None:
+                self._fail_all(f"aria2c exited with code {self.process.returncode}")
+                return
+
+            with self.lock:
+                gids = list(self.active)
+
+            if not gids:
+                continue
+
+            try:
+                results = self.call("system.multicall", [
+                    {"methodName": "aria2.tellStatus", "params": [f"token:{self.secret}", gid, STATUS_KEYS]}
+                    for gid in gids
+                ])
+            except (OSError, RuntimeError) as e:
+                print(f"Failed to poll aria2c: {e}", file=sys.stderr)
+                continue
+
+            show_progress = time.monotonic() - last_progress >= self.progress_interval
+            if show_progress:
+                last_progress = time.monotonic()
+
+            for gid, result in zip(gids, results):
+                # Successful multicall entries are wrapped in a single element list
+                if not isinstance(result, list):
+                    status = {"status": "error", "errorMessage": str(result)}
+                else:
+                    status = result[0]
+
+                with self.lock:
+                    future, label = self.active[gid]
+
+                if status["status"] in ("complete", "error", "removed"):
+                    with self.lock:
+                        del self.active[gid]
+
+                    try:
+                        self.call("aria2.removeDownloadResult", gid)
+                    except (OSError, RuntimeError):
+                        pass
+
+                    future.set_result(status)
+                elif show_progress and status["status"] == "active":
+                    total = int(status.get("totalLength", 0))
+                    done = int(status.get("completedLength", 0))
+                    speed = int(status.get("downloadSpeed", 0))
+                    percent = f"{done * 100 // total}%" if total else "?"
+                    print(f"{label}: {done / 1048576:.1f}/{total / 1048576:.1f} MB ({percent}) "
+                          f"at {speed / 1024:.0f} KB/s")
+
+    def _fail_all(self, message: str):
+        """Resolve every active download as failed and stop accepting new ones, e.g. after aria2c died"""
+        print(message, file=sys.stderr)
+
+        with self.lock:
+            self.running = False
+            active = list(self.active.values())
+            self.active.clear()
+
+        for future, _ in active:
+            future.set_result({"status": "error", "errorMessage": message})
+
+    def shutdown(self):
+        if not self.running:
+            return
+
+        self.running = False
+
+        try:
+            self.call("aria2.shutdown")
+        except (OSError, RuntimeError):
+            pass
+
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
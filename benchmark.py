@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Local benchmarks for the download and processing backends, no RainClassroom account needed.
+#
+# usage: `benchmark.py download [--size-mb 256] [--files 64]`
+#        `benchmark.py encode [--duration 600] [--chunks N] [--encoder auto]`
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """SimpleHTTPRequestHandler with single-range `Range` support and keep-alive"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+
+        if range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start = int(first) if first else size - int(last)
+            end = int(last) if first and last else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        f = open(path, "rb")
+        f.seek(start)
+        self.remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        while self.remaining > 0:
+            data = source.read(min(256 * 1024, self.remaining))
+            if not data:
+                break
+            outputfile.write(data)
+            self.remaining -= len(data)
+
+
+def serve(directory: str):
+    handler = lambda *a, **kw: RangeRequestHandler(*a, directory=directory, **kw)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def timed(name: str, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {elapsed:8.2f}s")
+    return elapsed
+
+
+def benchmark_download(args):
+    from native_downloader import NativeDownloader
+
+    root = tempfile.mkdtemp(prefix="rc-bench-")
+    served = os.path.join(root, "served")
+    os.makedirs(served)
+
+    with open(os.path.join(served, "segment.mp4"), "wb") as f:
+        f.write(os.urandom(args.size_mb * 1024 * 1024))
+
+    for i in range(args.files):
+        with open(os.path.join(served, f"{i}.jpg"), "wb") as f:
+            f.write(os.urandom(200 * 1024))
+
+    server, base_url = serve(served)
+    slides = [(f"{base_url}/{i}.jpg", i) for i in range(args.files)]
+    print(f"{args.size_mb} MB segment, {args.files} x 200 KB slides served from {base_url}")
+
+    def run_native(out):
+        downloader = NativeDownloader()
+        downloader.download([(f"{base_url}/segment.mp4", os.path.join(out, "segment.mp4"))])
+        downloader.download([(url, os.path.join(out, f"{i}.jpg")) for url, i in slides])
+
+    def run_aria2c(out):
+        subprocess.run([args.aria2c_path, "-d", out, "-o", "segment.mp4", "-x", "16", "-s", "16", "-k", "1M",
+                        "--log-level", "warn", f"{base_url}/segment.mp4"], check=True, stdout=subprocess.DEVNULL)
+
+        input_file = os.path.join(out, "input.txt")
+        with open(input_file, "w", encoding="utf-8") as f:
+            for url, i in slides:
+                f.write(f"{url}\n out={i}.jpg\n")
+
+        subprocess.run([args.aria2c_path, "-d", out, "-i", input_file, "-x", "16", "-j", "16",
+                        "--log-level", "warn"], check=True, stdout=subprocess.DEVNULL)
+
+    def run_aria2_rpc(out):
+        from aria2_rpc import Aria2RPC
+
+        rpc = Aria2RPC(args.aria2c_path).start()
+        try:
+            failed = rpc.download([(f"{base_url}/segment.mp4", os.path.join(out, "segment.mp4"))], "segment")
+            failed += rpc.download([(url, os.path.join(out, f"{i}.jpg")) for url, i in slides], "slides")
+        finally:
+            rpc.shutdown()
+
+        if failed:
+            raise RuntimeError(f"aria2c RPC failed to download {len(failed)} files")
+
+    try:
+        timed("native", lambda: run_native(os.path.join(root, "native")))
+
+        if shutil.which(args.aria2c_path):
+            timed("aria2c", lambda: run_aria2c(os.path.join(root, "aria2c")))
+            timed("aria2-rpc", lambda: run_aria2_rpc(os.path.join(root, "aria2-rpc")))
+        else:
+            print("aria2c not found, skipping")
+    finally:
+        server.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def benchmark_encode(args):
+    import encoders
+    import video_processing
+
+    root = tempfile.mkdtemp(prefix="rc-bench-")
+    segments = []
+
+    # A replay is several segments; testsrc2 is busier than slides, which makes the comparison conservative
+    for i in range(args.segments):
+        path = os.path.join(root, f"segment-{i}.mp4")
+        subprocess.run([video_processing.FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+                        "-f", "lavfi", "-i", f"testsrc2=s=1280x720:r=25:d={args.duration / args.segments}",
+                        "-f", "lavfi", "-i", f"sine=d={args.duration / args.segments}",
+                        "-c:v", "libx264", "-preset", "ultrafast", "-g", "250", "-c:a", "aac", path], check=True)
+        segments.append(path)
+
+    concat_file = os.path.join(root, "concat.txt")
+    video_processing.write_chunk_list(concat_file, segments)
+    print(f"{args.duration}s test video in {args.segments} segments")
+
+    def run(chunks):
+        target_file = os.path.join(root, f"out-{chunks}.mp4")
+        encoders.configure(video_processing.FFMPEG_PATH, args.encoder, 1, chunks)
+        if video_processing.encode_concat_file(concat_file, root, "benchmark", target_file) is None:
+            raise RuntimeError(f"Encoding with {chunks} chunks failed")
+
+    try:
+        single = timed("single process", lambda: run(1))
+        chunked = timed(f"{args.chunks} chunks", lambda: run(args.chunks))
+        print(f"speedup {single / chunked:.2f}x")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+download_parser = subparsers.add_parser("download", help="Native downloader against aria2c and its RPC mode on a local HTTP server")
+download_parser.add_argument("--size-mb", type=int, default=256, help="Size of the large segment")
+download_parser.add_argument("--files", type=int, default=64, help="Number of small slide images")
+download_parser.add_argument("--aria2c-path", default="aria2c")
+download_parser.set_defaults(run=benchmark_download)
+
+encode_parser = subparsers.add_parser("encode", help="Chunked encoding against a single ffmpeg process")
+encode_parser.add_argument("--duration", type=int, default=600, help="Length of the test video in seconds")
+encode_parser.add_argument("--segments", type=int, default=3, help="Number of segments the test video is split into")
+encode_parser.add_argument("--chunks", type=int, default=os.cpu_count() or 1, help="Number of chunks encoded in parallel")
+encode_parser.add_argument("--encoder", default="auto", help="Encoder profile, see main.py --encoder")
+encode_parser.set_defaults(run=benchmark_encode)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    sys.exit(args.run(args))
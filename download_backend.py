@@ -0,0 +1,36 @@
+import threading
+
+DOWNLOADERS = ["aria2c", "aria2-rpc", "native"]
+
+_downloader = "aria2c"
+_aria2c_path = "aria2c"
+_client = None
+_client_lock = threading.Lock()
+
+
+def configure(downloader: str = "aria2c", aria2c_path: str = "aria2c"):
+    global _downloader, _aria2c_path
+    _downloader = downloader
+    _aria2c_path = aria2c_path
+
+
+def get_downloader() -> str:
+    return _downloader
+
+
+def get_client():
+    """The shared in-process download client, or None when downloads shell out to aria2c"""
+    global _client
+
+    if _downloader == "aria2c":
+        return None
+
+    with _client_lock:
+        if _client is None and _downloader == "native":
+            from native_downloader import NativeDownloader
+            _client = NativeDownloader()
+        elif _client is None:
+            from aria2_rpc import Aria2RPC
+            _client = Aria2RPC(_aria2c_path).start()
+
+    return _client
@@ -0,0 +1,116 @@
+import os
+import subprocess
+import sys
+
+# Lecture replays are mostly static slides: a low frame rate, long GOPs and screen-content tuning keep
+# files small without visible loss. `{threads}` is replaced with the threads available to each encode.
+ENCODER_PROFILES = {
+    'nvenc-av1': ('av1_nvenc', [
+        "-c:v", "av1_nvenc", "-cq", "36", "-g", "200", "-bf", "7", "-b_strategy", "1", "-sc_threshold", "80",
+        "-me_range", "16", "-surfaces", "64", "-bufsize", "12800k", "-refs", "16", "-r", "7.5", "-temporal-aq", "1",
+        "-rc-lookahead", "127",
+    ]),
+    'svtav1': ('libsvtav1', [
+        "-c:v", "libsvtav1", "-preset", "8", "-crf", "40", "-g", "300", "-r", "7.5",
+        "-svtav1-params", "tune=0:scm=1:lp={threads}",
+    ]),
+    'x265': ('libx265', [
+        "-c:v", "libx265", "-preset", "medium", "-crf", "28", "-g", "300", "-r", "7.5",
+        "-x265-params", "bframes=8:ref=6:pools={threads}:log-level=error",
+    ]),
+    'x264': ('libx264', [
+        "-c:v", "libx264", "-preset", "slow", "-tune", "stillimage", "-crf", "26", "-g", "300", "-r", "7.5",
+        "-threads", "{threads}",
+    ]),
+}
+
+# Order in which `auto` tries the profiles
+ENCODER_PREFERENCE = ['nvenc-av1', 'svtav1', 'x265', 'x264']
+
+_profile = None
+_threads = 1
+_chunks = 1
+
+
+def available_encoders(FFMPEG_PATH) -> set:
+    result = subprocess.run([FFMPEG_PATH, "-hide_banner", "-encoders"], capture_output=True, text=True)
+    if result.returncode != 0:
+        return set()
+
+    encoders = set()
+    for line in result.stdout.splitlines():
+        # " V....D av1_nvenc            NVIDIA NVENC av1 encoder"
+        parts = line.split()
+        if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] == "V":
+            encoders.add(parts[1])
+
+    return encoders
+
+
+def test_encode(FFMPEG_PATH, profile: str) -> bool:
+    """Listed encoders may still be unusable, e.g. nvenc without a GPU, so encode a few frames of a test pattern"""
+    command = [FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+               "-i", "color=c=black:s=320x240:r=7.5", "-frames:v", "8"]
+    command += video_args(profile, 1)
+    command += ["-f", "null", "-"]
+
+    try:
+        return subprocess.run(command, capture_output=True, timeout=60).returncode == 0
+    except subprocess.TimeoutExpired:
+        return False
+
+
+def video_args(profile: str, threads: int) -> list:
+    return [arg.replace("{threads}", str(threads)) for arg in ENCODER_PROFILES[profile][1]]
+
+
+def detect_encoder(FFMPEG_PATH, requested: str = "auto"):
+    """The first working profile, or `requested` if it works; None if no profile can encode"""
+    encoders = available_encoders(FFMPEG_PATH)
+    candidates = ENCODER_PREFERENCE if requested == "auto" else [requested]
+
+    for profile in candidates:
+        if ENCODER_PROFILES[profile][0] not in encoders:
+            print(f"Encoder {ENCODER_PROFILES[profile][0]} is not available in ffmpeg")
+            continue
+
+        if test_encode(FFMPEG_PATH, profile):
+            return profile
+
+        print(f"Encoder {ENCODER_PROFILES[profile][0]} failed a test encode")
+
+    return None
+
+
+def configure(FFMPEG_PATH, requested: str = "auto", encode_workers: int = 1, chunks: int = 1):
+    global _profile, _threads, _chunks
+
+    _profile = detect_encoder(FFMPEG_PATH, requested)
+    if _profile is None:
+        print(f"No usable video encoder found for '{requested}', please check your ffmpeg build", file=sys.stderr)
+        return None
+
+    # Split the cores between the encodes running at once
+    _threads = max(1, (os.cpu_count() or 1) // max(1, encode_workers))
+    _chunks = max(1, chunks)
+    print(f"Using encoder profile {_profile} with {_threads} threads per encode")
+    if _chunks > 1:
+        print(f"Encoding each video as {_chunks} parallel chunks")
+    return _profile
+
+
+def get_profile():
+    return _profile
+
+
+def get_chunks() -> int:
+    return _chunks
+
+
+def get_video_args(threads: int = None) -> list:
+    return video_args(_profile, _threads if threads is None else threads)
+
+
+def get_chunk_threads() -> int:
+    """Threads for each chunk of a chunked encode, which share the threads of one encode"""
+    return max(1, _threads // _chunks)
@@ -0,0 +1,182 @@
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import http_client
+from retry import RetryPolicy
+
+TIMEOUT = (10, 60)
+MAX_SEGMENT_WORKERS = 32
+
+_session = None
+_pool = None
+_lock = threading.Lock()
+
+
+def _get_session_and_pool():
+    global _session, _pool
+
+    with _lock:
+        if _session is None:
+            _session = http_client.create_session("hls", MAX_SEGMENT_WORKERS, TIMEOUT)
+            _pool = ThreadPoolExecutor(max_workers=MAX_SEGMENT_WORKERS, thread_name_prefix="hls-segment")
+
+    return _session, _pool
+
+
+def parse_attributes(line: str) -> dict:
+    """Parse the `KEY=VALUE,KEY="VALUE"` list of an HLS tag"""
+    attributes = {}
+    rest = line.split(":", 1)[1] if ":" in line else ""
+
+    while rest:
+        key, _, rest = rest.partition("=")
+        if rest.startswith('"'):
+            value, _, rest = rest[1:].partition('"')
+            rest = rest[1:] if rest.startswith(",") else rest
+        else:
+            value, _, rest = rest.partition(",")
+        attributes[key.strip()] = value
+
+    return attributes
+
+
+def parse_playlist(text: str, base_url: str) -> dict:
+    """Parse a master or media playlist.
+
+    Master playlists return `{'variants': [(bandwidth, url), ...]}`; media playlists return
+    `{'segments': [{'url', 'key', 'sequence'}, ...], 'map': url or None}` where `key` is the
+    `EXT-X-KEY` attribute dict in effect for that segment.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or lines[0] != "#EXTM3U":
+        raise ValueError("Not an HLS playlist")
+
+    variants = []
+    segments = []
+    init_map = None
+    key = None
+    sequence = 0
+    pending_variant = None
+
+    for line in lines[1:]:
+        if line.startswith("#EXT-X-STREAM-INF"):
+            pending_variant = int(parse_attributes(line).get("BANDWIDTH", 0))
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE"):
+            sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-KEY"):
+            key = parse_attributes(line)
+            if key.get("METHOD", "NONE") == "NONE":
+                key = None
+            elif "URI" in key:
+                key["URI"] = urljoin(base_url, key["URI"])
+        elif line.startswith("#EXT-X-MAP"):
+            init_map = urljoin(base_url, parse_attributes(line)["URI"])
+        elif line.startswith("#"):
+            continue
+        elif pending_variant is not None:
+            variants.append((pending_variant, urljoin(base_url, line)))
+            pending_variant = None
+        else:
+            segments.append({'url': urljoin(base_url, line), 'key': key, 'sequence': sequence})
+            sequence += 1
+
+    if variants:
+        return {'variants': variants}
+
+    return {'segments': segments, 'map': init_map}
+
+
+def decrypt_aes128(data: bytes, key: bytes, iv: bytes) -> bytes:
+    try:
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    except ImportError:
+        raise RuntimeError("This stream is AES-128 encrypted. Please install cryptography using 'pip install cryptography'")
+
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    data = decryptor.update(data) + decryptor.finalize()
+    return data[:-data[-1]] if data else data
+
+
+def _get(session, url: str, policy: RetryPolicy) -> bytes:
+    def get():
+        response = session.get(url, timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+    return policy.call(get, description=url)
+
+
+def download_hls(FFMPEG_PATH, url: str, output_path: str, work_dir: str, max_retries: int = 10) -> int:
+    """Fetch every media segment of an HLS stream concurrently and remux them into `output_path` once.
+
+    Segments are kept in `work_dir` until the remux succeeds so that an interrupted download
+    only re-fetches the missing ones. Returns the ffmpeg exit code.
+    """
+    session, pool = _get_session_and_pool()
+    policy = RetryPolicy("hls", attempts=max_retries + 1, base_delay=0.5, max_delay=10)
+
+    playlist = parse_playlist(_get(session, url, policy).decode("utf-8"), url)
+    if 'variants' in playlist:
+        variant_url = max(playlist['variants'])[1]
+        playlist = parse_playlist(_get(session, variant_url, policy).decode("utf-8"), variant_url)
+
+    os.makedirs(work_dir, exist_ok=True)
+
+    keys = {}
+    keys_lock = threading.Lock()
+
+    def get_key(uri):
+        with keys_lock:
+            if uri not in keys:
+                keys[uri] = _get(session, uri, policy)
+            return keys[uri]
+
+    def fetch(index, segment):
+        path = os.path.join(work_dir, f"{index:05d}.ts")
+        if os.path.exists(path):
+            return path
+
+        data = _get(session, segment['url'], policy)
+
+        key = segment['key']
+        if key is not None:
+            if key.get("METHOD") != "AES-128":
+                raise RuntimeError(f"Unsupported HLS encryption {key.get('METHOD')}")
+
+            iv = int(key["IV"], 16).to_bytes(16, "big") if "IV" in key else segment['sequence'].to_bytes(16, "big")
+            data = decrypt_aes128(data, get_key(key["URI"]), iv)
+
+        with open(path + ".part", "wb") as f:
+            f.write(data)
+        os.replace(path + ".part", path)
+        return path
+
+    futures = [pool.submit(fetch, index, segment) for index, segment in enumerate(playlist['segments'])]
+    paths = [future.result() for future in futures]
+
+    print(f"Downloaded {len(paths)} HLS segments, remuxing into {output_path}")
+
+    remux = subprocess.Popen([FFMPEG_PATH, "-i", "pipe:0", "-c", "copy", "-n", output_path,
+                              "-hide_banner", "-loglevel", "error"], stdin=subprocess.PIPE)
+
+    try:
+        if playlist['map'] is not None:
+            remux.stdin.write(_get(session, playlist['map'], policy))
+
+        for path in paths:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, remux.stdin)
+    except BrokenPipeError:
+        pass
+    finally:
+        remux.stdin.close()
+
+    returncode = remux.wait()
+    if returncode == 0:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return returncode
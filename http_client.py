@@ -0,0 +1,199 @@
+import socket
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import stats
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0"
+DEFAULT_POOL_SIZE = 16
+# Hosts kept in a session's pool at once; each of them gets its own `pool_size` connections
+POOLED_HOSTS = 16
+# Probe idle connections so that NAT and load balancers don't silently drop them between requests
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+_timeout = (10, 30)
+_host_pools = {}
+_clients = []
+_lock = threading.Lock()
+
+
+def configure(connect_timeout: float = 10, read_timeout: float = 30, host_pools: dict = None):
+    """Set the default timeouts and the per-host pool sizes of sessions created from now on"""
+    global _timeout, _host_pools
+    _timeout = (connect_timeout, read_timeout)
+    _host_pools = dict(host_pools or {})
+
+
+def parse_host_pools(specs: list) -> dict:
+    """Parse `HOST=SIZE` options into a dict"""
+    host_pools = {}
+
+    for spec in specs or []:
+        host, _, size = spec.partition("=")
+        if not host or not size.isdigit() or int(size) < 1:
+            raise ValueError(f"Invalid host pool size '{spec}', expected HOST=SIZE")
+        host_pools[host.lower()] = int(size)
+
+    return host_pools
+
+
+class ConnectionStats:
+    """Counts requests and newly opened connections of one client; the rest reused a kept-alive connection"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.requests = 0
+        self.connections = 0
+        self.streams = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    def request(self):
+        with self.lock:
+            self.requests += 1
+
+    def connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def stream(self, stream):
+        """Count a request sent over `stream`, and a connection if the stream hasn't been seen before"""
+        with self.lock:
+            self.requests += 1
+            if stream is not None and stream not in self.streams:
+                self.streams.add(stream)
+                self.connections += 1
+
+    def summary(self) -> str:
+        with self.lock:
+            requests, connections = self.requests, self.connections
+
+        reused = max(0, requests - connections) / requests if requests else 0
+        return f"{self.name}: {requests} requests over {connections} connections, {reused:.0%} reused"
+
+
+def _register(connection_stats: ConnectionStats):
+    with _lock:
+        _clients.append(connection_stats)
+
+
+def _report():
+    with _lock:
+        clients = [client for client in _clients if client.requests]
+
+    if clients:
+        return "HTTP connections", [client.summary() for client in clients]
+
+
+stats.add_reporter(_report)
+
+
+def _counting_pool(base, connection_stats: ConnectionStats):
+    class CountingPool(base):
+        def _new_conn(self):
+            connection_stats.connection()
+            return super()._new_conn()
+
+    return CountingPool
+
+
+class TunedAdapter(HTTPAdapter):
+    """HTTPAdapter with a default timeout, TCP keep-alive and connection accounting.
+
+    Failures are not retried here; callers wrap requests in a retry policy instead.
+    """
+
+    def __init__(self, connection_stats: ConnectionStats, pool_size: int = DEFAULT_POOL_SIZE, timeout: tuple = None):
+        self.connection_stats = connection_stats
+        self.timeout = timeout or _timeout
+        super().__init__(pool_connections=POOLED_HOSTS, pool_maxsize=pool_size, max_retries=0)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault("socket_options", KEEPALIVE_SOCKET_OPTIONS)
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self.connection_stats),
+            "https": _counting_pool(HTTPSConnectionPool, self.connection_stats),
+        }
+
+    def send(self, request, timeout=None, **kwargs):
+        self.connection_stats.request()
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+class HTTP2Session:
+    """A requests-style facade over an httpx client speaking HTTP/2, which multiplexes requests on one connection"""
+
+    def __init__(self, connection_stats: ConnectionStats, pool_size: int, timeout: tuple):
+        import httpx
+
+        self.httpx = httpx
+        self.connection_stats = connection_stats
+        self.client = httpx.Client(http2=True, follow_redirects=True, timeout=self._timeout(timeout),
+                                   limits=httpx.Limits(max_connections=pool_size,
+                                                       max_keepalive_connections=pool_size),
+                                   headers={"User-Agent": USER_AGENT},
+                                   event_hooks={"response": [self._count]})
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _timeout(self, timeout):
+        if isinstance(timeout, tuple):
+            return self.httpx.Timeout(timeout[1], connect=timeout[0])
+        return timeout
+
+    def _count(self, response):
+        self.connection_stats.stream(response.extensions.get("network_stream"))
+
+    def request(self, method: str, url: str, data=None, timeout=None, allow_redirects=True, **kwargs):
+        # requests sends str/bytes `data` as the raw body, httpx expects it as `content`
+        if isinstance(data, (str, bytes)):
+            kwargs['content'] = data
+        elif data is not None:
+            kwargs['data'] = data
+
+        if timeout is not None:
+            kwargs['timeout'] = self._timeout(timeout)
+
+        return self.client.request(method, url, follow_redirects=allow_redirects, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+def create_session(name: str, pool_size: int = DEFAULT_POOL_SIZE, timeout: tuple = None, http2: bool = False):
+    """A session keeping up to `pool_size` connections alive per host, or the size configured for the host.
+
+    Requests without a timeout use `timeout` or the configured default. Sessions are safe to share between
+    threads. With `http2`, an httpx client is returned behind the same interface.
+    """
+    connection_stats = ConnectionStats(name)
+    _register(connection_stats)
+
+    if http2:
+        return HTTP2Session(connection_stats, pool_size, timeout or _timeout)
+
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+
+    adapter = TunedAdapter(connection_stats, pool_size, timeout)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    for host, size in _host_pools.items():
+        adapter = TunedAdapter(connection_stats, size, timeout)
+        session.mount(f"http://{host}/", adapter)
+        session.mount(f"https://{host}/", adapter)
+
+    return session
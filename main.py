@@ -9,6 +9,11 @@ import re
 import traceback
 import option
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from collections import defaultdict
+import threading
+import itertools
 
 if sys.platform == 'win32':
     os.system('chcp 65001')
@@ -28,9 +33,36 @@ parser.add_argument("-nv", "--no-video", action="store_true", help="Don't Downlo
 parser.add_argument("-np", "--no-ppt", action="store_true", help="Don't Download PPT")
 parser.add_argument("-npc", "--no-convert-ppt-to-pdf", action="store_true", help="Don't Convert PPT to PDF")
 parser.add_argument("-npa", "--no-ppt-answer", action="store_true", help="Don't Store PPT Problem Answer")
-parser.add_argument("-np2", "--no-ppt-type2", action="store_true", help="Don't Download Type 2 PPT (requires selenium)")
+parser.add_argument("-np2", "--no-ppt-type2", action="store_true", help="Don't Download Type 2 (script) PPT")
+parser.add_argument("-fnt", "--font", default=None, help="TrueType/OpenType font with Chinese glyphs for PPT answers and type 2 slides, default is the first one found on the system")
 parser.add_argument("-cnf", "--course-name-filter", action="append", help="Filter Course Name", default=None)
 parser.add_argument("-lnf", "--lesson-name-filter", action="append", help="Filter Lesson Name", default=None)
+sync_sel_group = parser.add_mutually_exclusive_group()
+sync_sel_group.add_argument("-inc", "--incremental", action="store_true", help="Only process lessons newer than the last successful run of each course")
+sync_sel_group.add_argument("-full", "--full", action="store_true", help="Rescan every lesson, ignoring stored high-water marks (default)")
+parser.add_argument("-ps", "--page-size", type=int, default=100, help="Number of activities fetched per activity log page")
+parser.add_argument("-nac", "--no-api-cache", action="store_true", help="Don't cache API metadata responses on disk")
+parser.add_argument("-acs", "--api-cache-size", type=int, default=64, help="Maximum size of the API metadata cache in MB")
+parser.add_argument("-dl", "--downloader", choices=["aria2c", "aria2-rpc", "native"], default="aria2c", help="Video segment downloader. aria2c: one aria2c process per download; aria2-rpc: one shared aria2c RPC server; native: in-process multi-connection downloader")
+parser.add_argument("-cw", "--course-workers", type=int, default=4, help="Number of courses whose lesson lists are fetched in parallel")
+parser.add_argument("-lw", "--lesson-workers", type=int, default=1, help="Number of lessons whose video metadata is resolved in parallel")
+parser.add_argument("-pw", "--ppt-workers", type=int, default=2, help="Number of lessons whose PPTs are downloaded in parallel")
+parser.add_argument("-dw", "--download-workers", type=int, default=2, help="Number of videos downloading at once")
+parser.add_argument("-vw", "--verify-workers", type=int, default=1, help="Number of downloaded videos verified at once")
+parser.add_argument("-ew", "--encode-workers", type=int, default=max(1, (os.cpu_count() or 1) // 4),
+                    help="Number of videos concatenated/encoded at once, default is a quarter of the CPU cores")
+parser.add_argument("-cm", "--concat-mode", choices=["encode", "copy", "auto"], default="encode", help="encode: re-encode every lesson; copy: join segments without re-encoding when codec, resolution and timebase match; auto: like copy, transcoding only the mismatching segments")
+parser.add_argument("-enc", "--encoder", choices=["auto", "nvenc-av1", "svtav1", "x265", "x264"], default="auto", help="Video encoder profile, auto picks the first one that works in this order")
+parser.add_argument("-ech", "--encode-chunks", type=int, default=1, help="Split each video at keyframes into this many chunks that are encoded in parallel (1 disables chunking)")
+parser.add_argument("-st", "--stream", action="store_true", help="Encode videos straight from the CDN without keeping raw segments in the cache folder, for hosts with small disks")
+parser.add_argument("-iw", "--image-workers", type=int, default=max(1, (os.cpu_count() or 1) // 2), help="Number of worker processes adding answers to slides and converting decks to PDF, default is half of the CPU cores")
+parser.add_argument("-sw", "--segment-workers", type=int, default=6, help="Maximum number of video segments downloaded at once")
+parser.add_argument("-sr", "--segment-rate", type=float, default=2.0, help="Maximum number of segment downloads started per second")
+parser.add_argument("-rb", "--retry-budget", type=int, default=500, help="Maximum number of retries of failed requests and segment downloads in a run, after which failures are final")
+parser.add_argument("-cto", "--connect-timeout", type=float, default=10, help="Seconds to wait for a connection to the API server")
+parser.add_argument("-rto", "--read-timeout", type=float, default=30, help="Seconds to wait for an API response before the request fails and is retried")
+parser.add_argument("-hps", "--host-pool-size", action="append", metavar="HOST=SIZE", default=None, help="Keep up to SIZE connections alive to HOST, e.g. a video CDN; can be given several times")
+parser.add_argument("-h2", "--http2", action="store_true", help="Use HTTP/2 for API requests (requires httpx[http2])")
 
 original_format_help = parser.format_help
 def format_help():
@@ -40,10 +72,14 @@ requirements:
     - requests
     - websocket-client (qrcode login)
     - qrcode (qrcode login)
-    - Pillow (Add answer to problem; Convert PPT to PDF)
+    - Pillow (Add answer to problem; Convert non-JPEG slides to PDF; Render type 2 PPT)
+    - A font with Chinese glyphs, e.g. Microsoft YaHei, PingFang or Noto Sans CJK (Add answer to problem; Render type 2 PPT)
+    - cryptography (Only for AES-128 encrypted m3u8 replays)
+    - httpx[http2] (Only for --http2)
 
     - aria2c (Download files multi-threaded & resume support)
-    - ffmpeg with nvenc support (Concatenate video segments and convert to HEVC)
+    - ffmpeg with nvenc, libsvtav1, libx265 or libx264 (Concatenate video segments and convert to AV1/HEVC/H.264)
+    - ffprobe (Verify downloaded video segments)
 """
 
 parser.format_help = format_help
@@ -84,18 +120,33 @@ if args.session_cookie is None:
         print("qrcode is not installed. Please install it using 'pip install qrcode'", file=sys.stderr)
         exit(1)
 
-if args.ppt_to_pdf or args.ppt_problem_answer:
+if args.ppt_to_pdf or args.ppt_problem_answer or not args.no_ppt_type2:
     try:
         import PIL
     except ImportError:
         print("PIL is not installed. Please install it using 'pip install pillow'", file=sys.stderr)
         exit(1)
 
-if not args.no_ppt_type2:
+if args.ppt and (args.ppt_problem_answer or not args.no_ppt_type2):
+    import ppt_processing
+
+    font = ppt_processing.find_font(args.font)
+    if font is None:
+        if args.font is not None:
+            print(f"{args.font} is not a font with Chinese glyphs", file=sys.stderr)
+        else:
+            print("No font with Chinese glyphs found. Please install one (e.g. Noto Sans CJK) or pass it with '--font'", file=sys.stderr)
+        exit(1)
+
+    print(f"Drawing slide text with {font}")
+    ppt_processing.set_font(font)
+
+if args.http2:
     try:
-        import selenium
+        import httpx
+        import h2
     except ImportError:
-        print("selenium is not installed. Please install it using 'pip install selenium' or use -np2", file=sys.stderr)
+        print("httpx with HTTP/2 support is not installed. Please install it using 'pip install httpx[http2]'", file=sys.stderr)
         exit(1)
 
 if args.download_all:
@@ -120,6 +171,10 @@ if idm_flag and shutil.which('IDMan.exe') is None:
     print("IDMan.exe is not found. Please install IDM and add it to PATH, or specify '--no-idm' flag", file=sys.stderr)
     exit(1)
 
+if idm_flag and args.stream:
+    print("Streaming mode reads segments directly and cannot be used with IDM", file=sys.stderr)
+    exit(1)
+
 if idm_flag and sys.platform != 'win32':
     print("WARNING: Are you sure that you want to use IDM on a non-Windows system?", file=sys.stderr)
 
@@ -128,30 +183,56 @@ if shutil.which("aria2c") is None and os.path.exists("aria2c.exe"):
     args.__setattr__("aria2c_path", os.path.join(os.getcwd(), "aria2c"))
     print(f"aria2c is not found in PATH, using local binary at {args.aria2c_path}")
 
-if not idm_flag:
+if not idm_flag and args.downloader != "native":
     if shutil.which(args.aria2c_path) is None:
         print("aria2c is not found. Please install aria2 and add it to PATH, or use IDM instead", file=sys.stderr)
         exit(1)
 
     print("IDM is not enabled, aria2c will be used for downloading")
 
-import requests
+import http_client
+
+try:
+    http_client.configure(args.connect_timeout, args.read_timeout, http_client.parse_host_pools(args.host_pool_size))
+except ValueError as e:
+    print(e, file=sys.stderr)
+    exit(1)
+
+import download_backend
+
+download_backend.configure(args.downloader, args.aria2c_path)
+
+if args.video:
+    import encoders
+    from video_processing import FFMPEG_PATH
+
+    # Detect the encoder once instead of letting every lesson fail on an unusable one
+    if encoders.configure(FFMPEG_PATH, args.encoder, args.encode_workers, args.encode_chunks) is None and args.encoder != "auto":
+        exit(1)
+
 import json
 
 # --- --- --- Section Init --- --- --- #
 # Login to RainClassroom
 userinfo = {}
-rainclassroom_sess = requests.session()
+# Shared by every stage, with enough kept-alive connections for the parallel MOOC leaf and PPT deck lookups
+API_POOL_SIZE = 32
+rainclassroom_sess = http_client.create_session("api", API_POOL_SIZE, http2=args.http2)
 
 YKT_HOST = args.ykt_host
 DOWNLOAD_FOLDER = "data"
 CACHE_FOLDER = "cache"
 
-rainclassroom_sess.headers["User-Agent"] = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36 Edg/131.0.0.0"
-
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 os.makedirs(CACHE_FOLDER, exist_ok=True)
 
+from manifest import Manifest
+import retry
+import stats
+
+manifest = Manifest(f"{DOWNLOAD_FOLDER}/manifest.sqlite3")
+retry.configure(args.retry_budget)
+
 # --- --- --- Section Load Session --- --- --- #
 
 if args.session_cookie is not None:
@@ -207,17 +288,23 @@ with open(f"{DOWNLOAD_FOLDER}/session.txt", "a", encoding='utf-8') as f:
 class APIError(Exception):
     pass
 
-def check_response(r: dict):
+def api_failed(r: dict):
     if 'success' in r:
-        e = not r['success']
-    
+        return not r['success']
+
     elif 'errcode' in r:
-        e = r['errcode'] != 0
+        return r['errcode'] != 0
 
     elif 'code' in r:
-        e = r['code'] != 0
-    
-    else:
+        return r['code'] != 0
+
+    return None
+
+
+def check_response(r: dict):
+    e = api_failed(r)
+
+    if e is None:
         print(json.dumps(r))
         print("Unknown API return status")
         e = False
@@ -227,13 +314,50 @@ def check_response(r: dict):
         raise APIError()
 
 
+# --- --- --- Section API Cache --- --- --- #
+
+if not args.no_api_cache:
+    from api_cache import CachedSession
+
+
+    def get_user_id():
+        """The id of the logged-in user, which unlike the session cookie stays the same across logins"""
+        try:
+            r = rainclassroom_sess.get(f"https://{YKT_HOST}/v2/api/web/userinfo").json()
+            data = r['data'][0] if isinstance(r['data'], list) else r['data']
+            return f"user:{data['user_id']}"
+        except Exception:
+            print("Failed to get the user id, the API cache is only reused within this session", file=sys.stderr)
+            return None
+
+
+    rainclassroom_sess = CachedSession(rainclassroom_sess, f"{CACHE_FOLDER}/api", args.api_cache_size * 1024 * 1024,
+                                       is_valid=lambda r: api_failed(r) is False, identity=get_user_id())
+
+
+def get_json(url: str, **kwargs) -> dict:
+    """GET an API endpoint, retrying connection errors, timeouts and 5xx responses with backoff"""
+    def get():
+        response = rainclassroom_sess.get(url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    return retry.API_RETRY.call(get, description=url)
+
+
 # --- --- --- Section Get Course List --- --- --- #
 
 # 获取自己的课程列表
-shown_courses = rainclassroom_sess.get(f"https://{YKT_HOST}/v2/api/web/courses/list?identity=2").json()
+with ThreadPoolExecutor(max_workers=2) as executor:
+    shown_courses_future = executor.submit(
+        lambda: get_json(f"https://{YKT_HOST}/v2/api/web/courses/list?identity=2"))
+    hidden_courses_future = executor.submit(
+        lambda: get_json(f"https://{YKT_HOST}/v2/api/web/classroom_archive"))
+
+shown_courses = shown_courses_future.result()
 check_response(shown_courses)
 
-hidden_courses = rainclassroom_sess.get(f"https://{YKT_HOST}/v2/api/web/classroom_archive").json()
+hidden_courses = hidden_courses_future.result()
 check_response(hidden_courses)
 
 for course in hidden_courses['data']['classrooms']:
@@ -278,11 +402,171 @@ rainclassroom_sess.cookies['xtbz'] = 'ykt'
 # --- --- --- Section Get Lesson List --- --- --- #
 
 
-def get_lesson_list(course: dict, name_prefix: str = ""):
-    lesson_data = rainclassroom_sess.get(
-        f"https://{YKT_HOST}/v2/api/web/logs/learn/{course['classroom_id']}?actype=-1&page=0&offset=500&sort=-1").json()
-    check_response(lesson_data)
+class LessonMetadata:
+    """API responses of one lesson, shared by its video and PPT jobs so that each is fetched only once"""
+
+    def __init__(self):
+        self.responses = {}
+        self.locks = defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def get_json(self, url: str, **kwargs) -> dict:
+        with self.lock:
+            url_lock = self.locks[url]
+
+        # Concurrent jobs asking for the same URL wait for the first request instead of repeating it
+        with url_lock:
+            if url in self.responses:
+                return self.responses[url]
+
+            r = get_json(url, **kwargs)
+            # Failures are not kept, so that a later job asks again
+            if api_failed(r) is False:
+                self.responses[url] = r
+
+            return r
+
+
+@dataclass
+class LessonJob:
+    kind: str  # 'video' or 'ppt'
+    lesson: dict
+    name_prefix: str
+    progress: "CourseProgress"
+    metadata: LessonMetadata = field(default_factory=LessonMetadata)
+    # The lesson has no content yet (e.g. its replay isn't generated), so a later run must look at it again
+    unpublished: bool = False
+    # Video jobs resolved from this lesson that are still in the download/verify/encode stages
+    pending_videos: int = 0
+    failed_videos: int = 0
+    # The single video of a replay lesson, recorded for the whole lesson once it is done; lessons with several
+    # videos (MOOC, script) record each video by its media id instead
+    output_path: str | None = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+@dataclass
+class VideoJob:
+    lesson_job: LessonJob
+    name_prefix: str
+    fallback_flag: int
+    video_data: object  # replay data for v1/v3 lessons, the segment URL list for MOOC and script lessons
+    num_segments: int
+    ccid: str | None = None
+    segment_results: dict | None = None
+
+
+# High-water marks are only valid for the content they were recorded for
+SYNC_SCOPE = "+".join(k for k, enabled in (('video', args.video), ('ppt', args.ppt)) if enabled)
+# Replays normally appear within hours; a lesson still without one after this long is assumed to never get one
+UNPUBLISHED_GRACE_MS = 7 * 24 * 60 * 60 * 1000
+
+
+class CourseProgress:
+    """Tracks outstanding lesson jobs of a course and advances its high-water mark when all are done"""
+
+    def __init__(self, course: dict):
+        self.course = course
+        self.lessons = []
+        self.pending = 0
+        self.listing_done = False
+        self.listing_complete = False
+        self.failed = []
+        self.unpublished = []
+        self.lock = threading.Lock()
+
+    def add_lesson(self, lesson: dict, jobs: int):
+        with self.lock:
+            self.lessons.append(lesson)
+            self.pending += jobs
+
+    def finish_listing(self, complete: bool):
+        with self.lock:
+            self.listing_done = True
+            self.listing_complete = complete
+            finished = self.pending == 0
+
+        if finished:
+            self.commit()
+
+    def job_done(self, job: LessonJob, ok: bool):
+        with self.lock:
+            self.pending -= 1
+            if not ok:
+                self.failed.append(job.lesson)
+            elif job.unpublished:
+                self.unpublished.append(job.lesson)
+            finished = self.pending == 0 and self.listing_done
+
+        if finished:
+            self.commit()
+
+    def commit(self):
+        # A filtered or aborted run hasn't seen every lesson, so it can't vouch for the ones in between
+        if args.lesson_name_filter is not None or not self.listing_complete:
+            return
+
+        times = [lesson['create_time'] for lesson in self.lessons if lesson.get('create_time') is not None]
+        if not times:
+            return
+
+        # Lessons that failed, or that may still get content, hold the mark back until they are done
+        cutoff = time.time() * 1000 - UNPUBLISHED_GRACE_MS
+        held = self.failed + [lesson for lesson in self.unpublished
+                              if lesson.get('create_time') is not None and lesson['create_time'] >= cutoff]
+        held_times = [lesson['create_time'] for lesson in held if lesson.get('create_time') is not None]
+        high_water = min(held_times) - 1 if held_times else max(times)
+
+        old_high_water = manifest.get_high_water(self.course['classroom_id'], SYNC_SCOPE)
+        if old_high_water is not None and high_water <= old_high_water:
+            return
+
+        manifest.set_high_water(self.course['classroom_id'], SYNC_SCOPE, high_water)
+        print(f"Synced {self.course['name']} up to {high_water}")
+
+
+error_log_lock = threading.Lock()
+
+
+def log_failed_lesson(job: LessonJob):
+    kind = "Video" if job.kind == 'video' else "PPT"
+
+    with error_log_lock:
+        with open(f"{DOWNLOAD_FOLDER}/error.log", "a") as f:
+            f.write(f"{kind} for {job.name_prefix} - {job.lesson['title']}\n")
+            f.write(json.dumps(job.lesson) + "\n\n\n")
+
+    print(f"{kind} for {job.name_prefix} - {job.lesson['title']} failed to download", file=sys.stderr)
+
+
+def iter_activity_pages(classroom_id):
+    """Yield `(page_data, activities)` for each page of a classroom's activity log, newest first"""
+    page = 0
+    seen = set()
+
+    while True:
+        lesson_data = get_json(
+            f"https://{YKT_HOST}/v2/api/web/logs/learn/{classroom_id}?actype=-1&page={page}&offset={args.page_size}&sort=-1")
+        check_response(lesson_data)
+
+        activities = lesson_data['data']['activities']
+        new_activities = [a for a in activities if (a['type'], a['id']) not in seen]
+        seen.update((a['type'], a['id']) for a in new_activities)
+
+        yield lesson_data['data'], new_activities
+
+        # A short page is the last one; a page of repeats means the server ignored `page`
+        if len(activities) < args.page_size or len(new_activities) == 0:
+            return
+
+        if lesson_data['data'].get('count') is not None and len(seen) >= lesson_data['data']['count']:
+            return
+
+        page += 1
+
 
+def get_lesson_list(course: dict, name_prefix: str = ""):
+    """Yield `(lesson, name_prefix)` for every lesson of a course as its activity log pages arrive"""
     folder_name = f"{course['name']}-{course['teacher']['name']}"
     folder_name = option.windows_filesame_sanitizer(folder_name)
 
@@ -306,145 +590,292 @@ def get_lesson_list(course: dict, name_prefix: str = ""):
     name_prefix += folder_name.rstrip() + "/"
     name_prefix = option.windows_filesame_sanitizer(name_prefix)
 
-    if args.lesson_name_filter is not None:
-        lesson_data['data']['activities'] = [l for l in lesson_data['data']['activities'] if
-                                             args.lesson_name_filter in l['title']]
-
-    length = len(lesson_data['data']['activities'])
-
-    def parse_single_lesson(index: int, lesson: dict):
-        if lesson['type'] == 2:
-            print('Script type detected!')
-            download_lesson_video_type2(lesson, name_prefix + str(length - index))
-        elif lesson['type'] == 14 or lesson['type'] == 3:
-            print('Normal type detected!')
-            download_lesson_video(lesson, name_prefix + str(length - index))
-        elif lesson['type'] == 15:
-            print('MOOCv2 type detected!')
-            download_lesson_video_type15(lesson, name_prefix + str(length - index))
-        elif lesson['type'] == 17:
-            print('MOOCv1 type detected!')
-            download_lesson_video_type17(lesson, name_prefix + str(length - index))
-
-    if args.video:
-        failed_lessons = []
-
-        for index, lesson in enumerate(lesson_data['data']['activities']):
-            if not lesson['type'] in [2, 3, 14, 15, 17]:
+    pages = iter_activity_pages(course['classroom_id'])
+    first_page, activities = next(pages)
+
+    # Lessons are numbered oldest first, so the total has to be known before the first one is named.
+    # Without a count from the server, every page has to be loaded up front.
+    length = first_page.get('count')
+    if length is None:
+        for _, page_activities in pages:
+            activities += page_activities
+
+        length = len(activities)
+        pages = iter(())
+
+    index = 0
+
+    for page_activities in itertools.chain([activities], (p for _, p in pages)):
+        for lesson in page_activities:
+            index += 1
+
+            if args.lesson_name_filter is not None and not any(f in lesson['title'] for f in args.lesson_name_filter):
                 continue
 
             lesson['classroom_id'] = course['classroom_id']
+            yield lesson, name_prefix + str(length - index + 1)
+
+
+def parse_single_lesson(job: LessonJob) -> list:
+    lesson = job.lesson
+    if lesson['type'] == 2:
+        print('Script type detected!')
+        return resolve_lesson_video_type2(job)
+    elif lesson['type'] == 14 or lesson['type'] == 3:
+        print('Normal type detected!')
+        return resolve_lesson_video(job)
+    elif lesson['type'] == 15:
+        print('MOOCv2 type detected!')
+        return resolve_lesson_video_type15(job)
+    elif lesson['type'] == 17:
+        print('MOOCv1 type detected!')
+        return resolve_lesson_video_type17(job)
+
+    return []
+
+
+def parse_single_lesson_ppt(job: LessonJob):
+    lesson = job.lesson
+    if lesson['type'] == 2:
+        print('Script type detected!')
+        if not args.no_ppt_type2:
+            download_lesson_ppt_type2(job)
+    elif lesson['type'] in [14, 3]:
+        print('Normal type detected!')
+        download_lesson_ppt(job)
+    elif lesson['type'] in [15, 17]:
+        print('MOOC type has no PPT')
+    elif lesson['type'] in [6, 9]:
+        print('Announcement type has no PPT')
+
+
+def crawl_course(course: dict):
+    high_water = None
+    if args.incremental:
+        high_water = manifest.get_high_water(course['classroom_id'], SYNC_SCOPE)
+
+    progress = CourseProgress(course)
+    complete = False
 
-            # Lesson
-            try:
-                parse_single_lesson(index, lesson)
-            except Exception:
-                print(traceback.format_exc())
-                print(f"Failed to download video for {name_prefix} - {lesson['title']}", file=sys.stderr)
-                failed_lessons.append((index, lesson))
-
-        if len(failed_lessons) > 0:
-            print('Retrying failed lessons')
-
-            for retry_count in range(3):
-                if len(failed_lessons) == 0:
-                    break
-
-                print(f"Retry #{retry_count + 1}")
-                still_failed_lessons = []
-                for index, lesson in failed_lessons:
-                    try:
-                        parse_single_lesson(index, lesson)
-                    except Exception:
-                        print(traceback.format_exc())
-                        print(f"Failed to download video for {name_prefix} - {lesson['title']}", file=sys.stderr)
-                        still_failed_lessons.append((index, lesson))
-
-                failed_lessons = still_failed_lessons
-            
-            if len(failed_lessons) > 0:
-                with open(f"{DOWNLOAD_FOLDER}/error.log", "a") as f:
-                    for index, lesson in failed_lessons:
-                        f.write(f"Video for {name_prefix} - {lesson['title']}\n")
-                        f.write(json.dumps(lesson) + "\n\n\n")
-
-                        print(f"Video for {name_prefix} - {lesson['title']} failed to download", file=sys.stderr)
-
-    if args.ppt:
-        failed_lessons = []
-        for index, lesson in enumerate(lesson_data['data']['activities']):
-            lesson['classroom_id'] = course['classroom_id']
+    try:
+        for lesson, name_prefix in get_lesson_list(course):
+            # The activity log is sorted newest first, so everything from here on was synced before
+            if high_water is not None and lesson.get('create_time') is not None and lesson['create_time'] <= high_water:
+                print(f"Incremental sync of {course['name']}: remaining lessons were already synced")
+                break
 
-            # Lesson
-            try:
-                if lesson['type'] == 2:
-                    print('Script type detected!')
-                    download_lesson_ppt_type2(lesson, name_prefix + str(length - index))
-                elif lesson['type'] in [14, 3]:
-                    print('Normal type detected!')
-                    download_lesson_ppt(lesson, name_prefix + str(length - index))
-                elif lesson['type'] in [15, 17]:
-                    print('MOOC type has no PPT')
-                elif lesson['type'] in [6, 9]:
-                    print('Announcement type has no PPT')
-                    
-            except Exception:
-                print(traceback.format_exc())
-                print(f"Failed to download PPT for {name_prefix} - {lesson['title']}", file=sys.stderr)
-                failed_lessons.append((index, lesson))
-        
-        if len(failed_lessons) > 0:
-            print('Retrying failed lessons')
-
-            for retry_count in range(3):
-                if len(failed_lessons) == 0:
-                    break
-
-                print(f"Retry #{retry_count + 1}")
-                still_failed_lessons = []
-                for index, lesson in failed_lessons:
-                    try:
-                        download_lesson_ppt(lesson, name_prefix + str(length - index))
-                    except Exception:
-                        print(traceback.format_exc())
-                        print(f"Failed to download PPT for {name_prefix} - {lesson['title']}", file=sys.stderr)
-                        still_failed_lessons.append((index, lesson))
-
-                failed_lessons = still_failed_lessons
-            
-            if len(failed_lessons) > 0:
-                with open(f"{DOWNLOAD_FOLDER}/error.log", "a") as f:
-                    for index, lesson in failed_lessons:
-                        f.write(f"PPT for {name_prefix} - {lesson['title']}\n")
-                        f.write(json.dumps(lesson) + "\n\n\n")
-
-                        print(f"PPT for {name_prefix} - {lesson['title']} failed to download", file=sys.stderr)
+            # Both jobs of a lesson share its metadata and are processed by their own stages side by side
+            metadata = LessonMetadata()
+            jobs = []
+            if args.video and lesson['type'] in [2, 3, 14, 15, 17]:
+                jobs.append(LessonJob('video', lesson, name_prefix, progress, metadata))
+            if args.ppt:
+                jobs.append(LessonJob('ppt', lesson, name_prefix, progress, metadata))
 
-# --- --- --- Section Download Lesson Video --- --- --- #
+            progress.add_lesson(lesson, len(jobs))
+            for job in jobs:
+                stage_for(job).put(job)
+
+        complete = True
+    finally:
+        progress.finish_listing(complete)
+
+
+def finish_lesson(job: LessonJob, ok: bool):
+    # Transient failures were already retried request by request, so a failed lesson is final for this run
+    if not ok:
+        log_failed_lesson(job)
+
+    job.progress.job_done(job, ok)
+
+
+def finish_video_lesson(job: LessonJob):
+    ok = job.failed_videos == 0
+    if ok and job.output_path is not None:
+        manifest.record('video', job.lesson['classroom_id'], job.lesson['courseware_id'], job.output_path)
+
+    finish_lesson(job, ok)
 
-from video_processing import download_segments_in_parallel, concatenate_segments
 
-def download_lesson_video(lesson: dict, name_prefix: str = ""):
-    lesson_video_data = rainclassroom_sess.get(
-        f"https://{YKT_HOST}/api/v3/lesson-summary/replay?lesson_id={lesson['courseware_id']}").json()
+def video_job_done(video_job: VideoJob, ok: bool):
+    job = video_job.lesson_job
+
+    with job.lock:
+        job.pending_videos -= 1
+        if not ok:
+            job.failed_videos += 1
+        finished = job.pending_videos == 0
+
+    if finished:
+        finish_video_lesson(job)
+
+
+def process_lesson(job: LessonJob):
+    video_jobs = []
+
     try:
-        check_response(lesson_video_data)
-    except APIError:
-        print('v3 protocol failed, falling back to v1')
-        fallback_flag = 1
-        lesson_video_data = rainclassroom_sess.get(
-            f"https://{YKT_HOST}/v/lesson/get_lesson_replay_timeline/?lesson_id={lesson['courseware_id']}").json()
-        check_response(lesson_video_data)
+        if job.kind == 'video':
+            video_jobs = parse_single_lesson(job)
+        else:
+            parse_single_lesson_ppt(job)
+    except Exception:
+        print(traceback.format_exc())
+        finish_lesson(job, False)
+        return
+
+    if job.kind != 'video':
+        finish_lesson(job, True)
+        return
+
+    if not video_jobs:
+        finish_video_lesson(job)
+        return
+
+    with job.lock:
+        job.pending_videos = len(video_jobs)
+
+    # Streamed videos are read by ffmpeg directly, so there is nothing to download or verify
+    next_stage = encode_stage if args.stream else download_stage
+    for video_job in video_jobs:
+        next_stage.put(video_job)
+
+
+def download_video(video_job: VideoJob):
+    try:
+        lesson_future = submit_segments(idm_flag, video_job.fallback_flag, CACHE_FOLDER, video_job.video_data,
+                                        video_job.name_prefix)
+        video_job.segment_results = lesson_future.result()
+    except Exception:
+        print(traceback.format_exc())
+        print(f"Failed to download {video_job.name_prefix}", file=sys.stderr)
+        video_job_done(video_job, False)
+        return
+
+    verify_stage.put(video_job)
+
+
+def verify_video(video_job: VideoJob):
+    try:
+        check_segments(idm_flag, video_job.segment_results, video_job.name_prefix)
+        verify_and_repair_segments(idm_flag, video_job.fallback_flag, CACHE_FOLDER, video_job.video_data,
+                                   video_job.name_prefix)
+    except Exception:
+        print(traceback.format_exc())
+        print('concatenate cannot start due to previous failure')
+        video_job_done(video_job, False)
+        return
+
+    encode_stage.put(video_job)
+
+
+def encode_video(video_job: VideoJob):
+    print(f"Concatenating {video_job.name_prefix}")
+
+    try:
+        if args.stream:
+            target_file = stream_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, video_job.fallback_flag,
+                                          video_job.video_data, video_job.name_prefix, args.concat_mode)
+        else:
+            target_file = concatenate_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, video_job.name_prefix,
+                                               video_job.num_segments, args.concat_mode)
+    except Exception:
+        print(traceback.format_exc())
+        target_file = None
+
+    if target_file is None:
+        video_job_done(video_job, False)
+        return
+
+    job = video_job.lesson_job
+    if video_job.ccid is not None:
+        manifest.record('video', job.lesson['classroom_id'], job.lesson['courseware_id'], target_file,
+                        ccid=video_job.ccid)
+    elif job.output_path is None:
+        job.output_path = target_file
+
+    video_job_done(video_job, True)
+
+
+def stage_for(job: LessonJob):
+    return video_resolve_stage if job.kind == 'video' else ppt_stage
+
+
+def crawl_course_safe(course: dict):
+    try:
+        crawl_course(course)
+    except Exception:
+        print(traceback.format_exc())
+        print(f"Failed to parse {course['name']}", file=sys.stderr)
+
 
-        print('v1 protocol detected!')
+# --- --- --- Section Download Lesson Video --- --- --- #
+
+from video_processing import (submit_segments, check_segments, verify_and_repair_segments, concatenate_segments,
+                              stream_segments)
+from scheduler import configure_scheduler
+
+configure_scheduler(args.segment_workers, args.segment_rate)
+
+MOOC_RESOLVE_WORKERS = 8
+
+def negotiate_protocol(job: LessonJob, endpoint: str, urls: dict):
+    """Fetch lesson metadata from the v3 or v1 `urls`, trying the version that last worked for the classroom first.
+
+    Returns `(version, response)`; raises APIError if no version works.
+    """
+    classroom_id = job.lesson['classroom_id']
+    known = manifest.get_protocol(classroom_id, endpoint)
+    versions = [1, 3] if known == 1 else [3, 1]
+
+    for version in versions:
+        data = job.metadata.get_json(urls[version])
+        try:
+            check_response(data)
+        except APIError:
+            stats.incr("Protocol negotiation", f"{endpoint} v{version} failed")
+            if version == versions[-1]:
+                raise
+
+            print(f'v{version} protocol failed, falling back to v{versions[-1]}')
+            continue
+
+        print(f'v{version} protocol detected!')
+        stats.incr("Protocol negotiation", f"{endpoint} v{version}")
+        if version != known:
+            manifest.set_protocol(classroom_id, endpoint, version)
+
+        return version, data
+
+
+def resolve_lesson_video(job: LessonJob) -> list:
+    lesson = job.lesson
+    name_prefix = job.name_prefix
+
+    if manifest.is_complete('video', lesson['classroom_id'], lesson['courseware_id']):
+        print(f"Skipping {name_prefix}-{lesson['title']} - Video recorded in manifest")
+        return []
+
+    version, lesson_video_data = negotiate_protocol(job, 'replay', {
+        3: f"https://{YKT_HOST}/api/v3/lesson-summary/replay?lesson_id={lesson['courseware_id']}",
+        1: f"https://{YKT_HOST}/v/lesson/get_lesson_replay_timeline/?lesson_id={lesson['courseware_id']}",
+    })
+    if version == 1:
+        fallback_flag = 1
         if 'live_timeline' not in lesson_video_data['data'] or len(lesson_video_data['data']['live_timeline']) == 0:
             print(f"Skipping {name_prefix} - No Video", file=sys.stderr)
-            return
+            job.unpublished = True
+            return []
+
+        num_segments = len(lesson_video_data['data']['live_timeline'])
     else:
         fallback_flag = 0
 
-        if 'live' not in lesson_video_data['data']:
+        if 'live' not in lesson_video_data['data'] or len(lesson_video_data['data']['live']) == 0:
             print(f"Skipping {name_prefix} - No Video", file=sys.stderr)
+            job.unpublished = True
+            return []
+
+        num_segments = len(lesson_video_data['data']['live'])
 
     name_prefix += "-" + lesson['title'].rstrip()
     name_prefix = option.windows_filesame_sanitizer(name_prefix)
@@ -454,257 +885,164 @@ def download_lesson_video(lesson: dict, name_prefix: str = ""):
 
     if os.path.exists(f"{DOWNLOAD_FOLDER}/{name_prefix}.mp4"):
         print(f"Skipping {name_prefix} - Video already present")
-        time.sleep(0.25)
-        return
+        job.output_path = f"{DOWNLOAD_FOLDER}/{name_prefix}.mp4"
+        return []
 
-    has_error = False
+    return [VideoJob(job, name_prefix, fallback_flag, lesson_video_data, num_segments)]
 
-    # Download segments in parallel
-    try:
-        download_segments_in_parallel(idm_flag, fallback_flag, CACHE_FOLDER, lesson_video_data, name_prefix)
-    except Exception:
-        print(traceback.format_exc())
-        print(f"Failed to download {name_prefix}", file=sys.stderr)
-        has_error = True
-
-    # Start concatenation if downloads were successful
-    if not has_error:
-        time.sleep(1)
-        if 'live' in lesson_video_data['data'] and len(lesson_video_data['data']['live']) > 0:
-            print(f"Concatenating {name_prefix}")
-            concatenate_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix, len(lesson_video_data['data']['live']))
-        elif 'live_timeline' in lesson_video_data['data'] and len(lesson_video_data['data']['live_timeline']) > 0:
-            print(f"Concatenating {name_prefix}")
-            concatenate_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix,
-                                 len(lesson_video_data['data']['live_timeline']))
-        else:
-            print('concatenate cannot start due to previous failure')
-    else:
-        print('concatenate cannot start due to previous failure')
 
-    if has_error:
-        with open(f"{DOWNLOAD_FOLDER}/error.log", "a") as f:
-            f.write(f"{name_prefix}\n")
+def resolve_mooc_leaf(job: LessonJob, leaf_id, name_prefix_leaf: str):
+    """Resolve a single MOOC leaf into a video job, or None if there is nothing to download"""
+    lesson = job.lesson
+    name_prefix_leaf = option.windows_filesame_sanitizer(name_prefix_leaf)
 
+    if idm_flag:
+        name_prefix_leaf = re.sub(r'[“”]', '_', name_prefix_leaf)
+
+    mooc_leaf_data = get_json(
+        f"https://{YKT_HOST}/mooc-api/v1/lms/learn/leaf_info/{str(lesson['classroom_id'])}/{str(leaf_id)}/",
+        headers={
+            "Xtbz": "ykt",
+            "Classroom-Id": str(lesson['classroom_id'])
+        }
+    )
+    check_response(mooc_leaf_data)
+
+    if 'data' not in mooc_leaf_data or 'content_info' not in mooc_leaf_data['data']:
+        print('no media detected, skipping!')
+        return None
 
-def download_lesson_video_type15(lesson: dict, name_prefix: str = ""):
-    mooc_data = rainclassroom_sess.get(
+    mooc_media_id = mooc_leaf_data['data']['content_info']['media']['ccid']
+
+    if manifest.is_complete('video', lesson['classroom_id'], lesson['courseware_id'], ccid=mooc_media_id):
+        print(f"Skipping {name_prefix_leaf} - Video recorded in manifest")
+        return None
+
+    mooc_media_data = get_json(
+        f"https://{YKT_HOST}/api/open/audiovideo/playurl?video_id={mooc_media_id}&provider=cc&is_single=0&format=json"
+    )
+    check_response(mooc_media_data)
+
+    quality_keys = list(map(lambda x: (int(x[7:]), x), mooc_media_data['data']['playurl']['sources'].keys()))
+    quality_keys.sort(key=lambda x: x[0], reverse=True)
+    download_url_list = mooc_media_data['data']['playurl']['sources'][quality_keys[0][1]]
+
+    if len(download_url_list) == 0:
+        print('no media detected, skipping!')
+        return None
+
+    return VideoJob(job, name_prefix_leaf, 2, download_url_list, len(download_url_list), ccid=mooc_media_id)
+
+
+def resolve_lesson_video_type15(job: LessonJob) -> list:
+    lesson = job.lesson
+    name_prefix = job.name_prefix
+
+    mooc_data = job.metadata.get_json(
         f"https://{YKT_HOST}/c27/online_courseware/xty/kls/pub_news/{lesson['courseware_id']}/",
         headers={
             "Xtbz": "ykt",
             "Classroom-Id": str(lesson['classroom_id'])
         }
-    ).json()
+    )
     check_response(mooc_data)
 
+    leaves = []
+
     for chapter in mooc_data['data']['content_info']:
         chapter_name = chapter['name']
 
         for orphan in chapter['leaf_list']:
-            orphan_title = orphan['title']
-            orphan_id = orphan['id']
-            has_error = False
-
-            name_prefix_orphan = name_prefix + chapter_name + " - " + orphan_title
-            name_prefix_orphan = option.windows_filesame_sanitizer(name_prefix_orphan)
-
-            if idm_flag:
-                name_prefix_orphan = re.sub(r'[“”]', '_', name_prefix_orphan)
-
-            mooc_orphan_data = rainclassroom_sess.get(
-                f"https://{YKT_HOST}/mooc-api/v1/lms/learn/leaf_info/{str(lesson['classroom_id'])}/{str(orphan_id)}/",
-                headers={
-                    "Xtbz": "ykt",
-                    "Classroom-Id": str(lesson['classroom_id'])
-                }
-            ).json()
-            check_response(mooc_orphan_data)
-
-            if 'data' not in mooc_orphan_data or 'content_info' not in mooc_orphan_data['data']:
-                print('no media detected, skipping!')
-                continue
-
-            mooc_orphan_media_id = mooc_orphan_data['data']['content_info']['media']['ccid']
-            mooc_orphan_media_data = rainclassroom_sess.get(
-                f"https://{YKT_HOST}/api/open/audiovideo/playurl?video_id={mooc_orphan_media_id}&provider=cc&is_single=0&format=json"
-            ).json()
-            check_response(mooc_orphan_media_data)
-
-            quality_keys = list(map(lambda x: (int(x[7:]), x), mooc_orphan_media_data['data']['playurl']['sources'].keys()))
-            quality_keys.sort(key=lambda x: x[0], reverse=True)
-            download_url_list = mooc_orphan_media_data['data']['playurl']['sources'][quality_keys[0][1]]
-            # print(download_url_list)
-
-            # Download segments in parallel
-            try:
-                download_segments_in_parallel(idm_flag, 2, CACHE_FOLDER, download_url_list, name_prefix_orphan)
-            except Exception:
-                print(traceback.format_exc())
-                print(f"Failed to download {name_prefix}", file=sys.stderr)
-                has_error = True
-
-            # Start concatenation if downloads were successful
-            if not has_error:
-                time.sleep(0.25)
-                if 'playurl' in mooc_orphan_media_data['data'] and len(download_url_list) > 0:
-                    print(f"Concatenating {name_prefix}")
-                    concatenate_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix_orphan, len(download_url_list))
-                else:
-                    print('concatenate cannot start due to previous failure')
-            else:
-                print('concatenate cannot start due to previous failure')
-
-            if has_error:
-                with open(f"{DOWNLOAD_FOLDER}/error.log", "a") as f:
-                    f.write(f"{name_prefix}\n")
+            leaves.append((orphan['id'], name_prefix + chapter_name + " - " + orphan['title']))
 
         for section in chapter['section_list']:
             section_name = section['name']
 
             for lesson_d in section['leaf_list']:
-                lesson_name = lesson_d['title']
-                lesson_id = lesson_d['id']
-                has_error = False
+                leaves.append((lesson_d['id'], name_prefix + chapter_name + " - " + section_name + " - " + lesson_d['title']))
 
-                name_prefix_lesson = name_prefix + chapter_name + " - " + section_name + " - " + lesson_name
-                name_prefix_lesson = option.windows_filesame_sanitizer(name_prefix_lesson)
+    def resolve_leaf(leaf):
+        try:
+            return resolve_mooc_leaf(job, *leaf)
+        except Exception as e:
+            print(traceback.format_exc())
+            print(f"Failed to resolve {leaf[1]}", file=sys.stderr)
+            return e
 
-                if idm_flag:
-                    name_prefix_lesson = re.sub(r'[“”]', '_', name_prefix_lesson)
-
-                mooc_lesson_data = rainclassroom_sess.get(
-                    f"https://{YKT_HOST}/mooc-api/v1/lms/learn/leaf_info/{str(lesson['classroom_id'])}/{str(lesson_id)}/",
-                    headers={
-                        "Xtbz": "ykt",
-                        "Classroom-Id": str(lesson['classroom_id'])
-                    }
-                ).json()
-                check_response(mooc_lesson_data)
-
-                if 'data' not in mooc_lesson_data or 'content_info' not in mooc_lesson_data['data']:
-                    print('no media detected, skipping!')
-                    continue
+    # Each leaf needs two API round-trips before anything can be downloaded, resolve them side by side
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=MOOC_RESOLVE_WORKERS) as pool:
+        resolved = list(pool.map(resolve_leaf, leaves))
+    elapsed = time.monotonic() - start
 
-                mooc_media_id = mooc_lesson_data['data']['content_info']['media']['ccid']
+    # The leaves that did resolve are still downloaded, the failed ones fail the lesson so it is tried again
+    failed = sum(isinstance(result, Exception) for result in resolved)
+    if failed:
+        with job.lock:
+            job.failed_videos += failed
+        stats.incr("MOOC", "leaves failed", failed)
 
-                mooc_media_data = rainclassroom_sess.get(
-                    f"https://{YKT_HOST}/api/open/audiovideo/playurl?video_id={mooc_media_id}&provider=cc&is_single=0&format=json"
-                ).json()
-                check_response(mooc_media_data)
+    video_jobs = []
+    seen_ccids = set()
+    for video_job in resolved:
+        if video_job is None or isinstance(video_job, Exception):
+            continue
 
-                quality_keys = list(map(lambda x: (int(x[7:]), x), mooc_media_data['data']['playurl']['sources'].keys()))
-                quality_keys.sort(key=lambda x: x[0], reverse=True)
-                download_url_list = mooc_media_data['data']['playurl']['sources'][quality_keys[0][1]]
-                # print(download_url_list)
-
-                # Download segments in parallel
-                try:
-                    download_segments_in_parallel(idm_flag, 2, CACHE_FOLDER, download_url_list, name_prefix_lesson)
-                except Exception:
-                    print(traceback.format_exc())
-                    print(f"Failed to download {name_prefix}", file=sys.stderr)
-                    has_error = True
-
-                # Start concatenation if downloads were successful
-                if not has_error:
-                    time.sleep(1)
-                    if 'playurl' in mooc_media_data['data'] and len(download_url_list) > 0:
-                        print(f"Concatenating {name_prefix}")
-                        concatenate_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix_lesson, len(download_url_list))
-                    else:
-                        print('concatenate cannot start due to previous failure')
-                else:
-                    print('concatenate cannot start due to previous failure')
+        # The same media can be linked from several leaves
+        if video_job.ccid in seen_ccids:
+            print(f"Skipping {video_job.name_prefix} - same video as another leaf")
+            stats.incr("MOOC", "duplicate videos skipped")
+            continue
 
-                if has_error:
-                    with open(f"{DOWNLOAD_FOLDER}/error.log", "a") as f:
-                        f.write(f"{name_prefix}\n")
+        seen_ccids.add(video_job.ccid)
+        video_jobs.append(video_job)
 
+    print(f"Resolved {len(leaves)} leaves of {name_prefix} into {len(video_jobs)} videos in {elapsed:.2f}s")
+    stats.incr("MOOC", "leaves resolved", len(leaves))
+    stats.incr("MOOC", "resolve time (ms)", round(elapsed * 1000))
 
-def download_lesson_video_type17(lesson: dict, name_prefix: str = ""):
-    mooc_data = rainclassroom_sess.get(
+    return video_jobs
+
+
+def resolve_lesson_video_type17(job: LessonJob) -> list:
+    lesson = job.lesson
+    name_prefix = job.name_prefix
+
+    mooc_data = job.metadata.get_json(
         f"https://{YKT_HOST}/c27/online_courseware/xty/kls/pub_news/{lesson['courseware_id']}/",
         headers={
             "Xtbz": "ykt",
             "Classroom-Id": str(lesson['classroom_id'])
         }
-    ).json()
+    )
     check_response(mooc_data)
 
     if 'name' not in mooc_data['data']['content_info'] or 'content_info' not in mooc_data['data']:
         print('no media detected, skipping!')
-        return
+        return []
 
     only_lesson_name = mooc_data['data']['content_info']['name']
     only_lesson_id = mooc_data['data']['content_info']['id']
 
-    has_error = False
+    video_job = resolve_mooc_leaf(job, only_lesson_id, name_prefix + only_lesson_name)
 
-    name_prefix_lesson = name_prefix + only_lesson_name
-    name_prefix_lesson = option.windows_filesame_sanitizer(name_prefix_lesson)
+    return [] if video_job is None else [video_job]
 
-    if idm_flag:
-        name_prefix_lesson = re.sub(r'[“”]', '_', name_prefix_lesson)
 
-    mooc_lesson_data = rainclassroom_sess.get(
-        f"https://{YKT_HOST}/mooc-api/v1/lms/learn/leaf_info/{str(lesson['classroom_id'])}/{str(only_lesson_id)}/",
-        headers={
-            "Xtbz": "ykt",
-            "Classroom-Id": str(lesson['classroom_id'])
-        }
-    ).json()
-    check_response(mooc_lesson_data)
-
-    if 'data' not in mooc_lesson_data or 'content_info' not in mooc_lesson_data['data']:
-        print('no media detected, skipping!')
-        return
-
-    mooc_media_id = mooc_lesson_data['data']['content_info']['media']['ccid']
-
-    mooc_media_data = rainclassroom_sess.get(
-        f"https://{YKT_HOST}/api/open/audiovideo/playurl?video_id={mooc_media_id}&provider=cc&is_single=0&format=json"
-    ).json()
-    check_response(mooc_media_data)
-
-    quality_keys = list(map(lambda x: (int(x[7:]), x), mooc_media_data['data']['playurl']['sources'].keys()))
-    quality_keys.sort(key=lambda x: x[0], reverse=True)
-    download_url_list = mooc_media_data['data']['playurl']['sources'][quality_keys[0][1]]
-    # print(download_url_list)
-
-    # Download segments in parallel
-    try:
-        download_segments_in_parallel(idm_flag, 2, CACHE_FOLDER, download_url_list, name_prefix_lesson)
-    except Exception:
-        print(traceback.format_exc())
-        print(f"Failed to download {name_prefix}", file=sys.stderr)
-        has_error = True
-
-    # Start concatenation if downloads were successful
-    if not has_error:
-        time.sleep(1)
-        if 'playurl' in mooc_media_data['data'] and len(download_url_list) > 0:
-            print(f"Concatenating {name_prefix}")
-            concatenate_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix_lesson, len(download_url_list))
-        else:
-            print('concatenate cannot start due to previous failure')
-    else:
-        print('concatenate cannot start due to previous failure')
-
-    if has_error:
-        with open(f"{DOWNLOAD_FOLDER}/error.log", "a") as f:
-            f.write(f"{name_prefix}\n")
-
-
-def download_lesson_video_type2(lesson: dict, name_prefix: str = ""):
+def resolve_lesson_video_type2(job: LessonJob) -> list:
     # "id": 6036907, "courseware_id": "1055476"
     # https://pro.yuketang.cn/v2/api/web/cards/detlist/1055476?classroom_id=3058049
-    
-    lesson_data = rainclassroom_sess.get(
-        f"https://{YKT_HOST}/v2/api/web/cards/detlist/{lesson['courseware_id']}?classroom_id={lesson['classroom_id']}").json()
+    lesson = job.lesson
+    name_prefix = job.name_prefix
+
+    lesson_data = job.metadata.get_json(
+        f"https://{YKT_HOST}/v2/api/web/cards/detlist/{lesson['courseware_id']}?classroom_id={lesson['classroom_id']}")
     check_response(lesson_data)
     name_prefix += "-" + lesson_data['data']['Title'].strip()
     
     name_prefix = option.windows_filesame_sanitizer(name_prefix)
+
+    video_jobs = []
     
     for slide in lesson_data['data']['Slides']:
         slide_id = slide['PageIndex']
@@ -721,160 +1059,139 @@ def download_lesson_video_type2(lesson: dict, name_prefix: str = ""):
                 if idm_flag:
                     name_prefix_shape = re.sub(r'[“”]', '_', name_prefix_shape)
 
-                # Download segments in parallel
-                try:
-                    download_segments_in_parallel(idm_flag, 2, CACHE_FOLDER, download_url_list, name_prefix_shape)
-                    has_error = False
-                except Exception:
-                    print(traceback.format_exc())
-                    print(f"Failed to download {name_prefix}", file=sys.stderr)
-                    has_error = True
-
-                # Start concatenation if downloads were successful
-                if not has_error:
-                    time.sleep(1)
-                    if 'playurl' in shape and len(download_url_list) > 0:
-                        print(f"Concatenating {name_prefix}")
-                        concatenate_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix_shape, len(download_url_list))
-                    else:
-                        print('concatenate cannot start due to previous failure')
-                else:
-                    print('concatenate cannot start due to previous failure')
+                if 'playurl' not in shape or len(download_url_list) == 0:
+                    continue
 
-                if has_error:
-                    with open(f"{DOWNLOAD_FOLDER}/error.log", "a") as f:
-                        f.write(f"{name_prefix}\n")
+                # Each video of the deck is recorded on its own, like the leaves of a MOOC
+                media_id = f"{slide_id}-{file_title}"
+                if manifest.is_complete('video', lesson['classroom_id'], lesson['courseware_id'], ccid=media_id):
+                    print(f"Skipping {name_prefix_shape} - Video recorded in manifest")
+                    continue
 
+                video_jobs.append(VideoJob(job, name_prefix_shape, 2, download_url_list, len(download_url_list),
+                                           ccid=media_id))
 
-from ppt_processing import download_ppt
+    return video_jobs
 
 
-def download_lesson_ppt(lesson: dict, name_prefix: str = ""):
-    name_prefix += "-" + lesson['title'].rstrip()
-    name_prefix = option.windows_filesame_sanitizer(name_prefix)
+from ppt_processing import download_ppt, download_card_deck, start_image_pool
+
+MAX_PARALLEL_DECKS = 4
+
+# A deck saved with other options is a different artifact, e.g. images without answers instead of a PDF
+PPT_OPTIONS = ('-pdf' if args.ppt_to_pdf else '') + ('-ans' if args.ppt_problem_answer else '')
+PPT_KIND = 'ppt' + PPT_OPTIONS
+PPT_TYPE2_KIND = 'ppt-type2' + PPT_OPTIONS
+
 
-    lesson_data = rainclassroom_sess.get(
-        f"https://{YKT_HOST}/api/v3/lesson-summary/student?lesson_id={lesson['courseware_id']}").json()
+def download_lesson_deck(lesson: dict, version: int, ppt_url: str, ppt: dict, name_prefix: str) -> bool:
+    if manifest.is_complete(PPT_KIND, lesson['classroom_id'], lesson['courseware_id'], presentation_id=ppt['id']):
+        print(f"Skipping {name_prefix} - {ppt['title']} - PPT recorded in manifest")
+        return True
+
+    # PPT
     try:
-        check_response(lesson_data)
-    except APIError:
-        print('v3 protocol failed, falling back to v1')
+        ppt_raw_data = get_json(ppt_url)
+        check_response(ppt_raw_data)
+        output = download_ppt(version, args.ppt_problem_answer, args.ppt_to_pdf, CACHE_FOLDER, DOWNLOAD_FOLDER,
+                              ppt_raw_data, name_prefix)
+        manifest.record(PPT_KIND, lesson['classroom_id'], lesson['courseware_id'], output,
+                        presentation_id=ppt['id'])
+        return True
+
+    except Exception as e:
+        print(traceback.format_exc())
+        print(f"Failed to download PPT {name_prefix} - {ppt['title']}", file=sys.stderr)
+        return False
 
-        ppt_info = rainclassroom_sess.get(
-            f"https://{YKT_HOST}/v2/api/web/lessonafter/{lesson['courseware_id']}/presentation?classroom_id={lesson['classroom_id']}").json()
-        check_response(ppt_info)
 
-        print('v1 protocol detected!')
+def download_lesson_ppt(job: LessonJob):
+    lesson = job.lesson
+    name_prefix = job.name_prefix
+
+    name_prefix += "-" + lesson['title'].rstrip()
+    name_prefix = option.windows_filesame_sanitizer(name_prefix)
+
+    decks = []
 
-        if 'id' not in ppt_info['data'][0]:
+    version, lesson_data = negotiate_protocol(job, 'presentation', {
+        3: f"https://{YKT_HOST}/api/v3/lesson-summary/student?lesson_id={lesson['courseware_id']}",
+        1: f"https://{YKT_HOST}/v2/api/web/lessonafter/{lesson['courseware_id']}/presentation?classroom_id={lesson['classroom_id']}",
+    })
+    if version == 1:
+        if 'id' not in lesson_data['data'][0]:
             print(f"Skipping {name_prefix} - No PPT", file=sys.stderr)
             return
 
-        for index, ppt in enumerate(ppt_info['data']):
-            # PPT
-            try:
-                ppt_raw_data = rainclassroom_sess.get(
-                    f"https://{YKT_HOST}/v2/api/web/lessonafter/presentation/{ppt['id']}?classroom_id={lesson['classroom_id']}").json()
-                check_response(ppt_raw_data)
-                download_ppt(1, args.ppt_problem_answer, args.ppt_to_pdf, CACHE_FOLDER, DOWNLOAD_FOLDER, args.aria2c_path,
-                             ppt_raw_data, name_prefix + f"-{index}")
-
-            except Exception as e:
-                print(traceback.format_exc())
-                print(f"Failed to download PPT {name_prefix} - {ppt['title']}", file=sys.stderr)
-
-    for index, ppt in enumerate(lesson_data['data']['presentations']):
-        # PPT
-        try:
-            ppt_raw_data = rainclassroom_sess.get(
-                f"https://{YKT_HOST}/api/v3/lesson-summary/student/presentation?presentation_id={ppt['id']}&lesson_id={lesson['courseware_id']}").json()
-            check_response(ppt_raw_data)
-            download_ppt(3, args.ppt_problem_answer, args.ppt_to_pdf, CACHE_FOLDER, DOWNLOAD_FOLDER, args.aria2c_path,
-                         ppt_raw_data, name_prefix + f"-{index}")
+        for index, ppt in enumerate(lesson_data['data']):
+            decks.append((1, f"https://{YKT_HOST}/v2/api/web/lessonafter/presentation/{ppt['id']}?classroom_id={lesson['classroom_id']}",
+                          ppt, name_prefix + f"-{index}"))
 
-        except Exception as e:
-            print(traceback.format_exc())
-            print(f"Failed to download PPT {name_prefix} - {ppt['title']}", file=sys.stderr)
+    else:
+        for index, ppt in enumerate(lesson_data['data']['presentations']):
+            decks.append((3, f"https://{YKT_HOST}/api/v3/lesson-summary/student/presentation?presentation_id={ppt['id']}&lesson_id={lesson['courseware_id']}",
+                          ppt, name_prefix + f"-{index}"))
 
+    # Slide images share one bounded pool, so the decks of a lesson can be fetched side by side
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_DECKS) as pool:
+        results = list(pool.map(lambda deck: download_lesson_deck(lesson, *deck), decks))
 
-def download_lesson_ppt_type2(lesson: dict, name_prefix: str = ""):
-    import selenium.webdriver
-    from selenium.webdriver.chrome.options import Options
+    if not all(results):
+        raise Exception(f"Failed to download some PPTs of {name_prefix}")
+
+
+def download_lesson_ppt_type2(job: LessonJob):
+    lesson = job.lesson
+    name_prefix = job.name_prefix
+
+    if manifest.is_complete(PPT_TYPE2_KIND, lesson['classroom_id'], lesson['courseware_id']):
+        print(f"Skipping {name_prefix} - PPT recorded in manifest")
+        return
 
-    lesson_data = rainclassroom_sess.get(
-        f"https://{YKT_HOST}/v2/api/web/cards/detlist/{lesson['courseware_id']}?classroom_id={lesson['classroom_id']}").json()
+    lesson_data = job.metadata.get_json(
+        f"https://{YKT_HOST}/v2/api/web/cards/detlist/{lesson['courseware_id']}?classroom_id={lesson['classroom_id']}")
     check_response(lesson_data)
 
     name_prefix = option.windows_filesame_sanitizer(name_prefix)[:name_prefix.rfind('/')]
 
-    ppt_name = lesson_data['data']['Title'] + '.pdf'
+    output = download_card_deck(args.ppt_to_pdf, DOWNLOAD_FOLDER, lesson_data['data'], name_prefix)
+    manifest.record(PPT_TYPE2_KIND, lesson['classroom_id'], lesson['courseware_id'], output)
 
-    if os.path.exists(os.path.join(DOWNLOAD_FOLDER, name_prefix, ppt_name)):
-        print(f"Skipping {name_prefix}/{ppt_name} - PPT already present")
-        return
 
-    ppt_data = json.dumps(lesson_data['data']).replace("\\", "\\\\").replace("`", "\\`")
+# --- --- --- Section Main --- --- --- #
 
-    # Create a Selenium WebDriver and set localstorage.rain_print of YKT_HOST to ppt_data
-    # driver = selenium.webdriver.Chrome()
-    # driver.get(f"https://{YKT_HOST}/")
-    # driver.execute_script(f"localStorage.rain_print = `{ppt_data}`")
+print('successfully parsed account info!')
 
-    # # Navigate to https://{YKT_HOST}/web/print and print webpage to PDF
-    # driver.get(f"https://{YKT_HOST}/web/print")
-    
-    # # Print to PDF without user's interaction
-    # driver.execute_script("window.print();")
-    
+if not download_type_flag:
+    selected_courses = []
+    for course in courses:
+        print(course)
+        if not option.ask_for_input():
+            selected_courses.append(course)
 
-    chrome_options = Options()
-    chrome_options.add_argument('--kiosk-printing')
-    # chrome_options.add_argument('--headless')
-    chrome_options.add_argument('--disable-gpu')
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-
-    prefs = {
-        'printing.print_preview_sticky_settings.appState': json.dumps({
-            'recentDestinations': [{
-                'id': 'Save as PDF',
-                'origin': 'local',
-                'account': '',
-            }],
-            'selectedDestinationId': 'Save as PDF',
-            'version': 2
-        }),
-        'savefile.default_directory': os.path.join(os.path.abspath(DOWNLOAD_FOLDER), name_prefix)
-    }
-    chrome_options.add_experimental_option('prefs', prefs)
-
-    driver = selenium.webdriver.Chrome(options=chrome_options)
-    driver.get(f"https://{YKT_HOST}/")
-    driver.execute_script(f"localStorage.rain_print = `{ppt_data}`")
-    driver.get(f"https://{YKT_HOST}/web/print")
-    time.sleep(3)
-    driver.execute_script("window.print();")
-    time.sleep(3)
-    driver.quit()
+    courses = selected_courses
 
+from pipeline import Pipeline
 
+# Bounded queues between the video stages keep downloads from running far ahead of encoding
+pipeline = Pipeline()
+course_stage = pipeline.stage("course", crawl_course_safe, workers=args.course_workers)
+video_resolve_stage = pipeline.stage("resolve", process_lesson, workers=args.lesson_workers)
+ppt_stage = pipeline.stage("ppt", process_lesson, workers=args.ppt_workers)
+download_stage = pipeline.stage("download", download_video, workers=args.download_workers,
+                                maxsize=2 * args.download_workers)
+verify_stage = pipeline.stage("verify", verify_video, workers=args.verify_workers, maxsize=2 * args.verify_workers)
+encode_stage = pipeline.stage("encode", encode_video, workers=args.encode_workers, maxsize=2 * args.encode_workers)
 
-# --- --- --- Section Main --- --- --- #
+stats.add_reporter(lambda: ("Pipeline", pipeline.utilization()))
 
-print('successfully parsed account info!')
+if args.ppt:
+    # Forked before the pipeline starts its threads
+    start_image_pool(args.image_workers)
+
+pipeline.start()
 
 for course in courses:
-    skip_flag = 0
-    try:
-        print(course)
-        if not download_type_flag:
-            skip_flag = option.ask_for_input()
-            if skip_flag:
-                continue
-            else:
-                get_lesson_list(course)
-        else:
-            get_lesson_list(course)
-    except Exception as e:
-        print(traceback.format_exc())
-        print(f"Failed to parse {course['name']}", file=sys.stderr)
+    course_stage.put(course)
+
+pipeline.join()
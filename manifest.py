@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class Manifest:
+    """Persistent index of finished downloads, used to skip work before any API call.
+
+    Artifacts are keyed by `(kind, classroom_id, courseware_id, presentation_id, ccid)`;
+    unused key parts are stored as empty strings. A record only counts as complete while
+    the file it points to still exists with the recorded size.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    kind TEXT NOT NULL,
+                    classroom_id TEXT NOT NULL,
+                    courseware_id TEXT NOT NULL,
+                    presentation_id TEXT NOT NULL DEFAULT '',
+                    ccid TEXT NOT NULL DEFAULT '',
+                    path TEXT NOT NULL,
+                    size INTEGER,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (kind, classroom_id, courseware_id, presentation_id, ccid)
+                )
+            """)
+            # Manifests written by earlier versions carry a checksum and stage that nothing read
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(artifacts)")}
+            for column in ("checksum", "stage"):
+                if column in columns:
+                    self.conn.execute(f"ALTER TABLE artifacts DROP COLUMN {column}")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    classroom_id TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    high_water INTEGER NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (classroom_id, scope)
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS protocols (
+                    classroom_id TEXT NOT NULL,
+                    endpoint TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (classroom_id, endpoint)
+                )
+            """)
+
+    @staticmethod
+    def _key(kind, classroom_id, courseware_id, presentation_id, ccid):
+        return kind, str(classroom_id), str(courseware_id), str(presentation_id or ''), str(ccid or '')
+
+    def lookup(self, kind: str, classroom_id, courseware_id, presentation_id=None, ccid=None):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, size FROM artifacts WHERE kind = ? AND classroom_id = ? "
+                "AND courseware_id = ? AND presentation_id = ? AND ccid = ?",
+                self._key(kind, classroom_id, courseware_id, presentation_id, ccid)).fetchone()
+
+        if row is None:
+            return None
+
+        return {'path': row[0], 'size': row[1]}
+
+    def is_complete(self, kind: str, classroom_id, courseware_id, presentation_id=None, ccid=None) -> bool:
+        record = self.lookup(kind, classroom_id, courseware_id, presentation_id, ccid)
+        if record is None:
+            return False
+
+        if not os.path.exists(record['path']):
+            return False
+
+        return record['size'] is None or os.path.getsize(record['path']) == record['size']
+
+    def record(self, kind: str, classroom_id, courseware_id, path: str, presentation_id=None, ccid=None):
+        size = os.path.getsize(path) if os.path.isfile(path) else None
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO artifacts "
+                "(kind, classroom_id, courseware_id, presentation_id, ccid, path, size, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._key(kind, classroom_id, courseware_id, presentation_id, ccid) + (path, size, time.time()))
+
+    def get_high_water(self, classroom_id, scope: str):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT high_water FROM sync_state WHERE classroom_id = ? AND scope = ?",
+                (str(classroom_id), scope)).fetchone()
+
+        return None if row is None else row[0]
+
+    def set_high_water(self, classroom_id, scope: str, high_water: int):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_state (classroom_id, scope, high_water, updated) VALUES (?, ?, ?, ?)",
+                (str(classroom_id), scope, int(high_water), time.time()))
+
+    def get_protocol(self, classroom_id, endpoint: str):
+        """The API version that last worked for `endpoint` in a classroom, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT version FROM protocols WHERE classroom_id = ? AND endpoint = ?",
+                (str(classroom_id), endpoint)).fetchone()
+
+        return None if row is None else row[0]
+
+    def set_protocol(self, classroom_id, endpoint: str, version: int):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO protocols (classroom_id, endpoint, version, updated) VALUES (?, ?, ?, ?)",
+                (str(classroom_id), endpoint, int(version), time.time()))
+
@@ -0,0 +1,160 @@
+import json
+import math
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import http_client
+
+from retry import CHUNK_RETRY, RetryableError
+
+CHUNK_SIZE = 4 * 1024 * 1024
+BUFFER_SIZE = 256 * 1024
+TIMEOUT = (10, 60)
+
+
+class NativeDownloader:
+    """In-process downloader on a pooled requests session.
+
+    Files of at least two chunks on servers that honour Range requests are fetched as parallel
+    chunks written at their offsets into a preallocated `<path>.part`; completed chunks are
+    listed in a `<path>.part.progress` sidecar so an interrupted download resumes where it
+    stopped. Smaller files are streamed in one request over a kept-alive connection.
+    """
+
+    def __init__(self, max_files: int = 16, max_connections: int = 32, connections_per_file: int = 16,
+                 chunk_size: int = CHUNK_SIZE):
+        self.connections_per_file = connections_per_file
+        self.chunk_size = chunk_size
+        self.session = http_client.create_session("native downloader", max_connections, TIMEOUT)
+
+        self.file_pool = ThreadPoolExecutor(max_workers=max_files, thread_name_prefix="native-file")
+        self.chunk_pool = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="native-chunk")
+
+    def download(self, items: list, label: str = "") -> list:
+        """Download `(url, out_path)` pairs and return the paths that failed"""
+        futures = [(path, self.file_pool.submit(self.fetch, url, path)) for url, path in items]
+
+        failed = []
+        for path, future in futures:
+            try:
+                future.result()
+            except Exception:
+                print(traceback.format_exc())
+                print(f"Failed to download {path}", file=sys.stderr)
+                failed.append(path)
+
+        return failed
+
+    def fetch(self, url: str, path: str):
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        size = self._probe(url)
+        if size is not None and size >= 2 * self.chunk_size:
+            self._fetch_ranges(url, path, size)
+        else:
+            self._fetch_single(url, path)
+
+        return path
+
+    def _probe(self, url: str):
+        """The file size if the server supports Range requests, otherwise None"""
+        with self.session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+
+            content_range = response.headers.get("Content-Range", "")
+            if response.status_code != 206 or "/" not in content_range:
+                return None
+
+            total = content_range.rsplit("/", 1)[1]
+            return int(total) if total.isdigit() else None
+
+    def _fetch_single(self, url: str, path: str):
+        part_path = path + ".part"
+
+        def get():
+            with self.session.get(url, stream=True, timeout=TIMEOUT) as response:
+                response.raise_for_status()
+                with open(part_path, "wb") as f:
+                    for data in response.iter_content(BUFFER_SIZE):
+                        f.write(data)
+
+        CHUNK_RETRY.call(get, description=url)
+
+        os.replace(part_path, path)
+
+    def _fetch_ranges(self, url: str, path: str, size: int):
+        part_path = path + ".part"
+        progress_path = part_path + ".progress"
+        chunks = math.ceil(size / self.chunk_size)
+
+        done = set()
+        try:
+            with open(progress_path, encoding="utf-8") as f:
+                progress = json.load(f)
+            if progress["size"] == size and progress["chunk_size"] == self.chunk_size and os.path.exists(part_path):
+                done = set(progress["done"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        if not done:
+            with open(part_path, "wb") as f:
+                f.truncate(size)
+
+        lock = threading.Lock()
+
+        def save_progress(index):
+            with lock:
+                done.add(index)
+                with open(progress_path, "w", encoding="utf-8") as f:
+                    json.dump({"size": size, "chunk_size": self.chunk_size, "done": sorted(done)}, f)
+
+        def run(index):
+            self._fetch_chunk(url, part_path, index * self.chunk_size, min(size, (index + 1) * self.chunk_size) - 1)
+            save_progress(index)
+
+        # Only keep `connections_per_file` chunks in the shared pool at a time
+        semaphore = threading.Semaphore(self.connections_per_file)
+        futures = []
+
+        for index in range(chunks):
+            if index in done:
+                continue
+
+            semaphore.acquire()
+            future = self.chunk_pool.submit(run, index)
+            future.add_done_callback(lambda _: semaphore.release())
+            futures.append(future)
+
+        for future in futures:
+            future.result()
+
+        os.replace(part_path, path)
+        os.remove(progress_path)
+
+    def _fetch_chunk(self, url: str, part_path: str, start: int, end: int):
+        CHUNK_RETRY.call(self._get_chunk, url, part_path, start, end, description=f"{url} range {start}-{end}")
+
+    def _get_chunk(self, url: str, part_path: str, start: int, end: int):
+        with self.session.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True,
+                              timeout=TIMEOUT) as response:
+            if response.status_code != 206:
+                raise requests.HTTPError(f"Expected 206 for range {start}-{end}, got {response.status_code}",
+                                         response=response)
+
+            with open(part_path, "r+b") as f:
+                f.seek(start)
+                written = 0
+                for data in response.iter_content(BUFFER_SIZE):
+                    f.write(data)
+                    written += len(data)
+
+        if written != end - start + 1:
+            raise RetryableError(f"Short read for range {start}-{end}: {written} bytes")
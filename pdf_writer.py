@@ -0,0 +1,147 @@
+import io
+import os
+import shutil
+
+# Start-of-frame markers carry the image size; C4 (DHT), C8 (JPG) and CC (DAC) share the range but are not frames
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+COLOR_SPACES = {1: "/DeviceGray", 3: "/DeviceRGB", 4: "/DeviceCMYK"}
+
+
+def jpeg_info(f) -> tuple:
+    """Width, height and number of components of a baseline or progressive JPEG file object"""
+    if f.read(2) != b"\xff\xd8":
+        raise ValueError("Not a JPEG file")
+
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("Corrupt JPEG marker")
+
+        # Markers may be preceded by fill bytes
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+
+        if 0xD0 <= marker[1] <= 0xD9 or marker[1] == 0x01:
+            continue
+
+        length = int.from_bytes(f.read(2), "big")
+        if marker[1] in SOF_MARKERS:
+            segment = f.read(length - 2)
+            height = int.from_bytes(segment[1:3], "big")
+            width = int.from_bytes(segment[3:5], "big")
+            return width, height, segment[5]
+
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+class PDFWriter:
+    """Writes a PDF with one full-page image per page, appending pages as they are added.
+
+    JPEG files are embedded as-is with DCTDecode, so they are neither decoded nor re-compressed and only one
+    page is ever held in memory. Pages are sized like Pillow's PDF plugin: `resolution` pixels per inch.
+    """
+
+    def __init__(self, path: str, resolution: float = 100.0):
+        self.f = open(path, "wb")
+        self.resolution = resolution
+        self.offsets = {}
+        self.pages = []
+        # 1 is the catalog and 2 the page tree, both written last
+        self.next_id = 3
+
+        self.f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+
+    def _begin(self, object_id: int = None) -> int:
+        if object_id is None:
+            object_id = self.next_id
+            self.next_id += 1
+
+        self.offsets[object_id] = self.f.tell()
+        self.f.write(f"{object_id} 0 obj\n".encode())
+        return object_id
+
+    def _object(self, body: str, object_id: int = None) -> int:
+        object_id = self._begin(object_id)
+        self.f.write(f"{body}\nendobj\n".encode())
+        return object_id
+
+    def _stream(self, dictionary: str, length: int, write) -> int:
+        object_id = self._begin()
+        self.f.write(f"<< {dictionary} /Length {length} >>\nstream\n".encode())
+        write(self.f)
+        self.f.write(b"\nendstream\nendobj\n")
+        return object_id
+
+    def add_image(self, path: str):
+        """Append a page with the image at `path`; other formats than JPEG are converted with Pillow"""
+        with open(path, "rb") as f:
+            try:
+                width, height, components = jpeg_info(f)
+            except ValueError:
+                width = None
+
+            if width is not None and components in COLOR_SPACES:
+                f.seek(0)
+                self._add_jpeg(width, height, components, os.path.getsize(path),
+                               lambda out: shutil.copyfileobj(f, out))
+                return
+
+        from PIL import Image
+
+        with Image.open(path) as image:
+            image = image.convert("L" if image.mode in ("1", "L") else "RGB")
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=95)
+
+        data = buffer.getvalue()
+        self._add_jpeg(image.width, image.height, 1 if image.mode == "L" else 3, len(data),
+                       lambda out: out.write(data))
+
+    def _add_jpeg(self, width: int, height: int, components: int, length: int, write):
+        dictionary = (f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                      f"/ColorSpace {COLOR_SPACES[components]} /BitsPerComponent 8 /Filter /DCTDecode")
+        if components == 4:
+            # Adobe CMYK JPEGs are stored inverted
+            dictionary += " /Decode [1 0 1 0 1 0 1 0]"
+
+        image_id = self._stream(dictionary, length, write)
+
+        page_width = width * 72.0 / self.resolution
+        page_height = height * 72.0 / self.resolution
+        content = f"q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /Im0 Do Q".encode()
+        content_id = self._stream("", len(content), lambda out: out.write(content))
+
+        self.pages.append(self._object(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.4f} {page_height:.4f}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>"))
+
+    def close(self):
+        kids = " ".join(f"{page} 0 R" for page in self.pages)
+        self._object(f"<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>", 2)
+        self._object("<< /Type /Catalog /Pages 2 0 R >>", 1)
+
+        xref = self.f.tell()
+        self.f.write(f"xref\n0 {self.next_id}\n0000000000 65535 f \n".encode())
+        for object_id in range(1, self.next_id):
+            self.f.write(f"{self.offsets[object_id]:010d} 00000 n \n".encode())
+
+        self.f.write(f"trailer\n<< /Size {self.next_id} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+        self.f.close()
+
+
+def images_to_pdf(images: list, path: str, resolution: float = 100.0):
+    """Write `images` as the pages of a PDF at `path`, which only appears once it is complete"""
+    with PDFWriter(path + ".part", resolution) as writer:
+        for image in images:
+            writer.add_image(image)
+
+    os.replace(path + ".part", path)
@@ -0,0 +1,119 @@
+import queue
+import sys
+import threading
+import time
+import traceback
+
+_STOP = object()
+
+
+class Pipeline:
+    """A set of stages whose handlers feed each other.
+
+    The pipeline counts items that are queued or being handled in any stage, so `join` only
+    returns once no stage has work left, even when later stages put items back into earlier ones.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.started = None
+        self.finished = None
+
+    def stage(self, name: str, handler, workers: int = 1, maxsize: int = 0) -> "Stage":
+        stage = Stage(self, name, handler, workers, maxsize)
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        self.started = time.monotonic()
+        for stage in self.stages:
+            stage.start()
+
+        return self
+
+    def _enter(self):
+        with self.condition:
+            self.in_flight += 1
+
+    def _leave(self):
+        with self.condition:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            while self.in_flight > 0:
+                self.condition.wait()
+
+        for stage in self.stages:
+            stage.stop()
+
+        self.finished = time.monotonic()
+
+    def utilization(self) -> list:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        lines = []
+
+        for stage in self.stages:
+            busy = stage.busy / (stage.workers * elapsed) if elapsed > 0 else 0
+            lines.append(f"{stage.name}: {stage.handled} items, {stage.workers} workers, {busy:.0%} busy, "
+                         f"{stage.busy:.1f}s total")
+
+        return lines
+
+
+class Stage:
+    """A pool of worker threads consuming items from a (optionally bounded) queue"""
+
+    def __init__(self, pipeline: Pipeline, name: str, handler, workers: int = 1, maxsize: int = 0):
+        self.pipeline = pipeline
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.busy = 0.0
+        self.handled = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        return self
+
+    def put(self, item):
+        self.pipeline._enter()
+        self.queue.put(item)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+
+            start = time.monotonic()
+            try:
+                self.handler(item)
+            except Exception:
+                print(traceback.format_exc())
+                print(f"Unhandled error in stage {self.name}", file=sys.stderr)
+            finally:
+                with self.lock:
+                    self.busy += time.monotonic() - start
+                    self.handled += 1
+                self.pipeline._leave()
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(_STOP)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
@@ -1,14 +1,254 @@
 import os
-import time
-import subprocess
 import re
 import option
+from slide_downloader import get_slide_downloader
+from pdf_writer import images_to_pdf
 import sys
+import threading
+import time
+import multiprocessing
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 WINDOWS = sys.platform == 'win32'
 
+# Fonts with Chinese glyphs shipped with common systems, tried in order when no font is given
+CJK_FONTS = [
+    "C:/Windows/Fonts/msyh.ttc",
+    "C:/Windows/Fonts/simhei.ttf",
+    "C:/Windows/Fonts/simsun.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "/System/Library/Fonts/STHeiti Medium.ttc",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/wenquanyi/wqy-microhei/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+]
+FONT_SIZE = 40
+
+_font_path = None
+_font = None
+_image_pool = None
+_image_pool_lock = threading.Lock()
+
+
+def covers_cjk(path: str) -> bool:
+    """Whether the font at `path` has Chinese glyphs; fonts without them draw every character as the same box"""
+    from PIL import Image, ImageDraw, ImageFont
+
+    try:
+        font = ImageFont.truetype(path, FONT_SIZE)
+    except OSError:
+        return False
+
+    def render(text):
+        image = Image.new("L", (FONT_SIZE * 2, FONT_SIZE * 2))
+        ImageDraw.Draw(image).text((0, 0), text, font=font, fill=255)
+        return image.tobytes()
+
+    return render("三") != render("相")
+
+
+def find_font(path: str = None):
+    """`path` if it is a usable font, otherwise the first system font with Chinese glyphs, or None"""
+    if path is not None:
+        return path if covers_cjk(path) else None
+
+    candidates = list(CJK_FONTS)
+    if shutil.which("fc-list"):
+        result = subprocess.run(["fc-list", ":lang=zh", "file"], capture_output=True, text=True)
+        candidates += [line.strip().rstrip(":") for line in result.stdout.splitlines() if line.strip()]
+
+    for candidate in candidates:
+        if os.path.isfile(candidate) and covers_cjk(candidate):
+            return candidate
+
+    return None
+
+
+def set_font(path: str):
+    """Use the font at `path` for answers and script-type slides; must be called before the pool starts"""
+    global _font_path
+    _font_path = path
+
+
+def _init_image_worker():
+    global _font
+    from PIL import ImageFont
+
+    # Loaded once per worker instead of for every slide; PDF conversion alone needs no font
+    if _font_path is not None:
+        _font = ImageFont.truetype(_font_path, FONT_SIZE)
+
+
+def start_image_pool(workers: int):
+    """Start the worker pool for answer overlays and PDF conversion.
+
+    Workers are forked, as spawning them would re-run the main script, and should be started before other
+    threads exist. Where fork is not available a thread pool is used instead.
+    """
+    global _image_pool
+
+    with _image_pool_lock:
+        if _image_pool is not None:
+            return _image_pool
+
+        if "fork" in multiprocessing.get_all_start_methods():
+            _image_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                              initializer=_init_image_worker)
+            # Workers are created on demand, create them all now
+            list(_image_pool.map(time.sleep, [0.1] * workers))
+        else:
+            _image_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image",
+                                             initializer=_init_image_worker)
+
+    return _image_pool
+
+
+def get_image_pool():
+    return start_image_pool(max(1, (os.cpu_count() or 1) // 2))
+
+
+def draw_answer(source: str, target: str, answer: str) -> str:
+    from PIL import Image, ImageDraw
+
+    image = Image.open(source).convert("RGB")
+
+    draw = ImageDraw.Draw(image)
+
+    text_bbox = draw.textbbox(xy=(20, 20), text=answer, font=_font)
+
+    # Add semi-transparent black rectangle
+    draw.rectangle([text_bbox[0] - 10, text_bbox[1] - 10, text_bbox[2] + 10, text_bbox[3] + 10], fill="#bbb")
+
+    # Draw the text on top (white)
+    draw.text((text_bbox[0], text_bbox[1]), answer, anchor="lt", font=_font, fill="#333")
+
+    image.save(target)
+
+    return target
+
+
+def card_box(shape: dict):
+    try:
+        return tuple(float(shape[key]) for key in ('Left', 'Top', 'Width', 'Height'))
+    except (KeyError, TypeError, ValueError):
+        return None
+
 
-def download_ppt(version, arg_ans, arg_pdf, CACHE_FOLDER, DOWNLOAD_FOLDER, ARIA2C_PATH, ppt_raw_data, name_prefix: str = ""):
+def render_card_slide(layers: list, deck_size, target: str) -> str:
+    """Compose one script-type slide from its layers and save it as a JPEG.
+
+    Each layer is a dict with a `box` in deck coordinates (None for the full page) and either an `image`
+    path or a `text`. The page takes the size of the full-page cover if there is one.
+    """
+    from PIL import Image, ImageDraw
+
+    size = None
+    for layer in layers:
+        if layer['box'] is None and layer.get('image'):
+            with Image.open(layer['image']) as cover:
+                size = cover.size
+            break
+
+    if size is None:
+        size = tuple(int(v) for v in deck_size) if deck_size else (1280, 720)
+
+    scale = size[0] / deck_size[0] if deck_size else 1.0
+    page = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(page)
+
+    for layer in layers:
+        if layer['box'] is None:
+            left, top, width, height = 0, 0, size[0], size[1]
+        else:
+            left, top, width, height = (round(v * scale) for v in layer['box'])
+
+        if layer.get('image'):
+            with Image.open(layer['image']) as image:
+                image = image.convert("RGBA").resize((max(1, width), max(1, height)))
+                page.paste(image, (left, top), image)
+        elif layer.get('text'):
+            if layer.get('placeholder'):
+                draw.rectangle([left, top, left + width, top + height], fill="#bbb")
+            draw.multiline_text((left + 10, top + 10), layer['text'], font=_font, fill="#333")
+
+    page.save(target, quality=90)
+    return target
+
+
+def download_card_deck(arg_pdf, DOWNLOAD_FOLDER, deck_data: dict, folder: str):
+    """Render a script-type (type 2) deck from its `cards/detlist` data without a browser"""
+    title = option.windows_filesame_sanitizer(deck_data['Title'].strip())
+    pdf_path = os.path.join(DOWNLOAD_FOLDER, folder, title + ".pdf")
+    image_dir = os.path.join(DOWNLOAD_FOLDER, folder, title)
+
+    if arg_pdf and os.path.exists(pdf_path):
+        print(f"Skipping {folder}/{title} - PDF already present")
+        return pdf_path
+
+    deck_size = None
+    if deck_data.get('Width') and deck_data.get('Height'):
+        deck_size = (float(deck_data['Width']), float(deck_data['Height']))
+
+    downloads = []
+    slides = []
+
+    for slide in sorted(deck_data['Slides'], key=lambda slide: slide.get('PageIndex', 0)):
+        index = slide.get('PageIndex', len(slides) + 1)
+        layers = []
+
+        cover = slide.get('Cover')
+        if cover:
+            downloads.append((cover, f"{image_dir}/{index}.jpg"))
+            layers.append({'box': None, 'image': f"{image_dir}/{index}.jpg"})
+
+        for number, shape in enumerate(slide.get('Shapes') or []):
+            box = card_box(shape)
+            url = shape.get('URL')
+
+            if box is None:
+                continue
+            elif url:
+                downloads.append((url, f"{image_dir}/{index}-{number}.img"))
+                layers.append({'box': box, 'image': f"{image_dir}/{index}-{number}.img"})
+            elif shape.get('file_title'):
+                # Videos embedded in the slide can't be printed, mark where they are
+                layers.append({'box': box, 'text': f"[Video] {shape['file_title']}", 'placeholder': True})
+            elif shape.get('Text'):
+                layers.append({'box': box, 'text': shape['Text']})
+
+        slides.append((index, layers))
+
+    failed = get_slide_downloader().download(downloads, f"{folder}/{title}")
+    if failed:
+        raise Exception(f"Failed to download {len(failed)} images of {folder}/{title}")
+
+    pool = get_image_pool()
+    start = time.monotonic()
+    futures = [pool.submit(render_card_slide, layers, deck_size, f"{image_dir}/{index}-page.jpg")
+               for index, layers in slides]
+    pages = [future.result() for future in futures]
+    render_time = time.monotonic() - start
+
+    if not arg_pdf:
+        print(f"Image processing of {folder}/{title}: {len(pages)} slides rendered in {render_time:.2f}s")
+        return image_dir
+
+    start = time.monotonic()
+    pool.submit(images_to_pdf, pages, pdf_path, 100.0).result()
+    print(f"Image processing of {folder}/{title}: {len(pages)} slides rendered in {render_time:.2f}s, "
+          f"PDF in {time.monotonic() - start:.2f}s")
+
+    return pdf_path
+
+
+def download_ppt(version, arg_ans, arg_pdf, CACHE_FOLDER, DOWNLOAD_FOLDER, ppt_raw_data, name_prefix: str = ""):
     print(f"Downloading {name_prefix}")
 
     if version == 1:
@@ -21,44 +261,24 @@ def download_ppt(version, arg_ans, arg_pdf, CACHE_FOLDER, DOWNLOAD_FOLDER, ARIA2
     # If PDF is present, skip
     if os.path.exists(f"{DOWNLOAD_FOLDER}/{name_prefix}.pdf"):
         print(f"Skipping {name_prefix} - PDF already present")
-        time.sleep(0.25)
-        return
+        return f"{DOWNLOAD_FOLDER}/{name_prefix}.pdf"
 
     os.makedirs(f"{DOWNLOAD_FOLDER}/{name_prefix}", exist_ok=True)
 
-    images = []
-
-    if version == 1:
-        with open(f"{CACHE_FOLDER}/ppt_download.txt", "w", encoding='utf-8') as f:
-            for slide in ppt_raw_data['data']['slides']:
-                if not slide.get('Cover'):
-                    continue
-
-                f.write(f"{slide['Cover']}\n out={DOWNLOAD_FOLDER}/{name_prefix}/{slide['Index']}.jpg\n")
-                images.append(f"{DOWNLOAD_FOLDER}/{name_prefix}/{slide['Index']}.jpg")
-
-    else:
-        with open(f"{CACHE_FOLDER}/ppt_download.txt", "w", encoding='utf-8') as f:
-            for slide in ppt_raw_data['data']['slides']:
-                if not slide.get('cover'):
-                    continue
+    cover_key, index_key = ('Cover', 'Index') if version == 1 else ('cover', 'index')
+    downloads = [(slide[cover_key], f"{DOWNLOAD_FOLDER}/{name_prefix}/{slide[index_key]}.jpg")
+                 for slide in ppt_raw_data['data']['slides'] if slide.get(cover_key)]
+    images = [path for _, path in downloads]
 
-                f.write(f"{slide['cover']}\n out={DOWNLOAD_FOLDER}/{name_prefix}/{slide['index']}.jpg\n")
-                images.append(f"{DOWNLOAD_FOLDER}/{name_prefix}/{slide['index']}.jpg")
+    failed = get_slide_downloader().download(downloads, name_prefix)
+    if failed:
+        raise Exception(f"Failed to download {len(failed)} slides of {name_prefix}")
 
-    ppt_download_command = (f"{ARIA2C_PATH} -i {CACHE_FOLDER}/ppt_download.txt -x 16 -j 16 -c "
-                            f"-l aria2c_ppt.log --log-level warn")
-
-    if WINDOWS:
-        subprocess.run(['powershell', '-Command', ppt_download_command], text=True)
-    else:
-        subprocess.run(ppt_download_command, shell=True)
-
-    from PIL import Image
+    pool = get_image_pool()
+    overlay_start = time.monotonic()
+    overlays = []
 
     if arg_ans and version != 1:
-        from PIL import ImageDraw, ImageFont
-
         for problem in ppt_raw_data['data']['slides']:
             if problem['problem'] is None:
                 continue
@@ -67,39 +287,30 @@ def download_ppt(version, arg_ans, arg_pdf, CACHE_FOLDER, DOWNLOAD_FOLDER, ARIA2
                 continue
 
             answer = "Answer: " + "; ".join(problem['problem']['content']['answer'])
+            source = f"{DOWNLOAD_FOLDER}/{name_prefix}/{problem['index']}.jpg"
+            target = f"{DOWNLOAD_FOLDER}/{name_prefix}/{problem['index']}-ans.jpg"
+            overlays.append((problem['index'], source, pool.submit(draw_answer, source, target, answer)))
 
-            image = Image.open(f"{DOWNLOAD_FOLDER}/{name_prefix}/{problem['index']}.jpg").convert("RGB")
-
-            draw = ImageDraw.Draw(image)
-
-            # Load the font
-            font = ImageFont.load_default(size=40)
-            text_bbox = draw.textbbox(xy=(20, 20), text=answer, font=font)
-
-            # Add semi-transparent black rectangle
-            draw.rectangle([text_bbox[0] - 10, text_bbox[1] - 10, text_bbox[2] + 10, text_bbox[3] + 10], fill="#bbb")
-
-            # Draw the text on top (white)
-            draw.text((text_bbox[0], text_bbox[1]), answer, anchor="lt", font=font, fill="#333")
-
-            image.save(f"{DOWNLOAD_FOLDER}/{name_prefix}/{problem['index']}-ans.jpg")
-
+        for index, source, future in overlays:
             # Replace the image in the list
-            images[images.index(
-                f"{DOWNLOAD_FOLDER}/{name_prefix}/{problem['index']}.jpg")] = f"{DOWNLOAD_FOLDER}/{name_prefix}/{problem['index']}-ans.jpg"
+            images[images.index(source)] = future.result()
+
+            print(f"Added Answer to {name_prefix} - {index}")
 
-            print(f"Added Answer to {name_prefix} - {problem['index']}")
+    overlay_time = time.monotonic() - overlay_start
 
     if not arg_pdf:
-        return
+        print(f"Image processing of {name_prefix}: {len(overlays)} answers in {overlay_time:.2f}s")
+        return f"{DOWNLOAD_FOLDER}/{name_prefix}"
 
     print(f"Converting {name_prefix}")
 
-    images = [Image.open(i) for i in images]
-    images[0].save(f"{DOWNLOAD_FOLDER}/{name_prefix}.pdf", "PDF", resolution=100.0, save_all=True,
-                   append_images=images[1:])
+    pdf_start = time.monotonic()
+    pool.submit(images_to_pdf, images, f"{DOWNLOAD_FOLDER}/{name_prefix}.pdf", 100.0).result()
+    pdf_time = time.monotonic() - pdf_start
 
     print(f"Converted {name_prefix}")
+    print(f"Image processing of {name_prefix}: {len(overlays)} answers in {overlay_time:.2f}s, "
+          f"{len(images)} pages PDF in {pdf_time:.2f}s")
 
-    # can be done like this TODO
-    # l2 = map(lambda x: x['B2'], ppt_raw_data['data']['slides'])
+    return f"{DOWNLOAD_FOLDER}/{name_prefix}.pdf"
@@ -0,0 +1,114 @@
+import random
+import sys
+import threading
+import time
+
+import requests
+
+import stats
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# Request timeouts, rate limiting and server errors; any other HTTP error will not go away by retrying
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    """A failure that may go away when the operation is repeated"""
+
+
+def is_retryable(e: Exception) -> bool:
+    """Only failures known to be transient are retried, everything else (bad URLs, TLS errors, ...) is final"""
+    if isinstance(e, RetryableError):
+        return True
+
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code in RETRYABLE_STATUSES
+
+    # Connect and read timeouts, refused or reset connections and bodies cut off mid-transfer
+    if isinstance(e, (requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+
+    if isinstance(e, requests.ConnectionError):
+        return not isinstance(e, (requests.exceptions.SSLError, requests.exceptions.ProxyError))
+
+    # The same failures from the HTTP/2 client
+    if httpx is not None:
+        if isinstance(e, httpx.HTTPStatusError):
+            return e.response.status_code in RETRYABLE_STATUSES
+
+        return isinstance(e, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError))
+
+    return False
+
+
+class RetryBudget:
+    """Caps the number of retries of a whole run, so a dead CDN or API fails fast instead of backing off forever"""
+
+    def __init__(self, retries: int):
+        self.remaining = retries
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+
+            self.remaining -= 1
+            return True
+
+
+_budget = RetryBudget(500)
+
+
+def configure(budget: int = 500):
+    global _budget
+    _budget = RetryBudget(budget)
+
+
+class RetryPolicy:
+    """Runs an operation again after retryable failures, with exponential backoff and jitter.
+
+    The n-th retry waits `base_delay * 2 ** n` seconds capped at `max_delay`, scaled by a random factor in
+    `[1 - jitter, 1 + jitter]` so that parallel failures don't retry in lockstep. Every retry draws from the
+    run-wide retry budget.
+    """
+
+    def __init__(self, name: str, attempts: int = 4, base_delay: float = 0.5, max_delay: float = 30.0,
+                 jitter: float = 0.5):
+        self.name = name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, retry: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** retry)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def call(self, fn, *args, description: str = "", **kwargs):
+        for attempt in range(self.attempts):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.attempts - 1:
+                    raise
+
+                if not _budget.take():
+                    stats.incr("Retries", "budget exhausted")
+                    raise
+
+                delay = self.delay(attempt)
+                stats.incr("Retries", self.name)
+                print(f"Retrying {description or self.name} in {delay:.1f}s "
+                      f"({attempt + 1}/{self.attempts - 1}): {e}", file=sys.stderr)
+                time.sleep(delay)
+
+
+API_RETRY = RetryPolicy("api", attempts=4, base_delay=1.0)
+SEGMENT_RETRY = RetryPolicy("segment", attempts=4, base_delay=2.0, max_delay=60.0)
+CHUNK_RETRY = RetryPolicy("chunk", attempts=5, base_delay=0.5)
+SLIDE_RETRY = RetryPolicy("slide", attempts=4, base_delay=0.5)
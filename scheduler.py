@@ -0,0 +1,100 @@
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class TokenBucket:
+    """Blocking token bucket, refilled at `rate` tokens per second up to `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class SegmentScheduler:
+    """Process-wide segment download pool shared by every lesson.
+
+    `submit_lesson` takes a list of `(order, fn, args, kwargs)` jobs and returns
+    a future resolved with `{order: result or exception}` once all of them are done.
+    """
+
+    def __init__(self, max_workers: int = 6, rate: float = 2.0, burst: int | None = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="segment")
+        self.bucket = TokenBucket(rate, burst if burst is not None else max_workers)
+
+    def _run(self, fn, args, kwargs):
+        self.bucket.acquire()
+        return fn(*args, **kwargs)
+
+    def submit_lesson(self, jobs: list) -> Future:
+        lesson_future = Future()
+        results = {}
+        remaining = [len(jobs)]
+        lock = threading.Lock()
+
+        if not jobs:
+            lesson_future.set_result(results)
+            return lesson_future
+
+        def on_done(order, future):
+            try:
+                results[order] = future.result()
+            except Exception as e:
+                print(traceback.format_exc())
+                results[order] = e
+
+            with lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+
+            if finished:
+                lesson_future.set_result(dict(sorted(results.items())))
+
+        for order, fn, args, kwargs in jobs:
+            future = self.executor.submit(self._run, fn, args, kwargs)
+            future.add_done_callback(lambda f, order=order: on_done(order, f))
+
+        return lesson_future
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def configure_scheduler(max_workers: int = 6, rate: float = 2.0, burst: int | None = None):
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = SegmentScheduler(max_workers, rate, burst)
+
+    return _scheduler
+
+
+def get_scheduler() -> SegmentScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = SegmentScheduler()
+
+    return _scheduler
@@ -0,0 +1,131 @@
+import json
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import http_client
+from retry import RETRYABLE_STATUSES, SLIDE_RETRY, RetryableError
+
+TIMEOUT = (10, 30)
+INDEX_FILE = ".slides.json"
+
+
+class SlideDownloader:
+    """Fetches slide images of every deck over one pooled keep-alive session.
+
+    A single worker pool bounds how many images are in flight across all decks and lessons. The size of
+    every fetched image is kept in an index next to it, so images already on disk are skipped without a
+    request; unknown files are checked with a HEAD request against their Content-Length.
+    """
+
+    def __init__(self, max_concurrent: int = 16):
+        self.session = http_client.create_session("slides", max_concurrent, TIMEOUT)
+
+        self.pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="slide")
+        self.index_lock = threading.Lock()
+
+    def download(self, items: list, label: str = "") -> list:
+        """Download `(url, out_path)` pairs and return the paths that failed"""
+        indexes = {}
+        for _, path in items:
+            folder = os.path.dirname(path)
+            if folder not in indexes:
+                indexes[folder] = self._load_index(folder)
+
+        futures = [(path, self.pool.submit(self.fetch, url, path, indexes[os.path.dirname(path)]))
+                   for url, path in items]
+
+        failed = []
+        fetched = 0
+        for path, future in futures:
+            try:
+                fetched += future.result()
+            except Exception:
+                print(traceback.format_exc())
+                print(f"Failed to download {path}", file=sys.stderr)
+                failed.append(path)
+
+        for folder, index in indexes.items():
+            self._save_index(folder, index)
+
+        print(f"Downloaded {fetched} slides of {label}, {len(items) - fetched - len(failed)} already present")
+        return failed
+
+    def fetch(self, url: str, path: str, index: dict) -> bool:
+        """Download one image unless an identical one is present, True if it was fetched"""
+        name = os.path.basename(path)
+
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+            known = index.get(name)
+
+            if known is not None and known['size'] == size:
+                return False
+
+            if SLIDE_RETRY.call(self._matches_remote, url, size, description=url):
+                with self.index_lock:
+                    index[name] = {'size': size}
+                return False
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        response = SLIDE_RETRY.call(self._get, url, description=url)
+
+        with open(path + ".part", "wb") as f:
+            f.write(response.content)
+        os.replace(path + ".part", path)
+
+        with self.index_lock:
+            index[name] = {'size': len(response.content)}
+
+        return True
+
+    def _matches_remote(self, url: str, size: int) -> bool:
+        """Whether the server reports `size` bytes for `url`; servers that refuse HEAD just don't match"""
+        response = self.session.head(url, allow_redirects=True, timeout=TIMEOUT)
+        if response.status_code in RETRYABLE_STATUSES:
+            response.raise_for_status()
+
+        return response.ok and response.headers.get('Content-Length') == str(size)
+
+    def _get(self, url: str) -> requests.Response:
+        response = self.session.get(url, timeout=TIMEOUT)
+        response.raise_for_status()
+
+        expected = response.headers.get('Content-Length')
+        if expected is not None and response.headers.get('Content-Encoding') is None \
+                and int(expected) != len(response.content):
+            raise RetryableError(f"Short read for {url}: {len(response.content)} of {expected} bytes")
+
+        return response
+
+    def _load_index(self, folder: str) -> dict:
+        try:
+            with open(os.path.join(folder, INDEX_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, folder: str, index: dict):
+        os.makedirs(folder or ".", exist_ok=True)
+        with self.index_lock:
+            with open(os.path.join(folder, INDEX_FILE), "w", encoding="utf-8") as f:
+                json.dump(index, f)
+
+
+_downloader = None
+_lock = threading.Lock()
+
+
+def get_slide_downloader() -> SlideDownloader:
+    global _downloader
+
+    with _lock:
+        if _downloader is None:
+            _downloader = SlideDownloader()
+
+    return _downloader
@@ -0,0 +1,51 @@
+import atexit
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_reporters = []
+
+
+def incr(section: str, name: str, amount: int = 1):
+    with _lock:
+        _counters[(section, name)] += amount
+
+
+def get(section: str, name: str) -> int:
+    with _lock:
+        return _counters[(section, name)]
+
+
+def add_reporter(reporter):
+    """Register a callable returning `(section, lines)` to be printed with the run statistics"""
+    with _lock:
+        _reporters.append(reporter)
+
+
+def report():
+    with _lock:
+        counters = dict(_counters)
+        reporters = list(_reporters)
+
+    sections = defaultdict(list)
+    for (section, name), value in counters.items():
+        sections[section].append(f"{name}: {value}")
+
+    for reporter in reporters:
+        result = reporter()
+        if result:
+            section, lines = result
+            sections[section] += lines
+
+    if not sections:
+        return
+
+    print("--- --- --- Run Statistics --- --- ---")
+    for section, lines in sections.items():
+        print(f"{section}:")
+        for line in lines:
+            print(f"    {line}")
+
+
+atexit.register(report)
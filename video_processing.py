@@ -2,19 +2,44 @@ import os
 import re
 import subprocess
 import sys
+import tempfile
 import time
-import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor
 import shutil
+from scheduler import get_scheduler
+import json
+import requests
+from collections import Counter
+import download_backend
+import encoders
+import http_client
+from hls_downloader import download_hls
+from retry import SEGMENT_RETRY, RetryableError
 
 FFMPEG_PATH = "ffmpeg" if shutil.which("ffmpeg") else os.path.join(os.getcwd(), "ffmpeg")
+FFPROBE_PATH = "ffprobe" if shutil.which("ffprobe") else os.path.join(os.getcwd(), "ffprobe")
 ARIA2C_PATH = "aria2c" if shutil.which("aria2c") else os.path.join(os.getcwd(), "aria2c")
 WINDOWS = sys.platform == 'win32'
 
+CONCAT_MODES = ["encode", "copy", "auto"]
+# Software encoders used to bring a mismatching segment in line with the others in `auto` concat mode
+SEGMENT_ENCODERS = {'h264': 'libx264', 'hevc': 'libx265', 'av1': 'libsvtav1'}
+# Lets the concat demuxer open segment URLs when streaming
+REMOTE_INPUT_ARGS = ["-protocol_whitelist", "file,http,https,tcp,tls,crypto"]
+VERIFY_WORKERS = 8
+
+# Content-Length checks of all lessons share kept-alive connections to the CDN
+verify_session = http_client.create_session("segment verify", VERIFY_WORKERS, (10, 30))
+
 
 def download_segment(CACHE_FOLDER, url: str, order: int, name_prefix: str = "") -> subprocess.CompletedProcess:
     print(f"Downloading {name_prefix} - {order}")
 
+    client = download_backend.get_client()
+    if client is not None:
+        failed = client.download([(url, f"{CACHE_FOLDER}/{name_prefix}-{order}.mp4")], name_prefix)
+        return 1 if failed else 0
+
     video_download_command = (f"{ARIA2C_PATH} -o '{CACHE_FOLDER}/{name_prefix}-{order}.mp4'"
                               f" -x 16 -s 16 -k 1M '{url}' --stream-piece-selector random -k 1M -c -l aria2c_video.log --log-level warn")
 
@@ -105,10 +130,11 @@ def download_segment_m3u8(idm_flag, CACHE_FOLDER, url: str, order: int, name_pre
                 f"idman /n /d \"{url}\" /p \"$(pwd)\" /f '{CACHE_FOLDER}/{name_prefix}-{order}.mp4'"
             )
         else:
-            video_download_command = (
-                f"{FFMPEG_PATH} -i '{url}' -c:v copy -c:a copy -n '{CACHE_FOLDER}/{name_prefix}-{order}.mp4' "
-                f"-hide_banner -loglevel error -stats"
-            )
+            if os.path.exists(f"{output_path}.mp4"):
+                print(f"Skipping {output_path}.mp4 - Video already present")
+                return 0
+
+            return download_hls(FFMPEG_PATH, url, f"{output_path}.mp4", f"{output_path}.hls", max_retries)
 
     else:
         video_download_command = (
@@ -125,189 +151,493 @@ def download_segment_m3u8(idm_flag, CACHE_FOLDER, url: str, order: int, name_pre
     return result.returncode
 
 
-def download_segments_in_parallel(idm_flag, fallback_flag, CACHE_FOLDER, lesson_video_data, name_prefix):
-    has_error = False
+def retry_segment(description: str, download, *args, **kwargs):
+    """Run a segment download again with backoff while the downloader exits with an error"""
+    def attempt():
+        returncode = download(*args, **kwargs)
+        if returncode != 0:
+            raise RetryableError(f"downloader returned {returncode}")
+        return returncode
 
+    return SEGMENT_RETRY.call(attempt, description=description)
+
+
+def segment_urls(fallback_flag, lesson_video_data) -> list:
     # MOOC TYPE
     if fallback_flag == 2:
-        # Create a ThreadPoolExecutor to manage parallel downloads
-        with ThreadPoolExecutor(max_workers=6) as executor:
-            # Dictionary to hold future results
-            future_to_order = {}
-
-            for order, url in enumerate(lesson_video_data):
-                if idm_flag:
-                    future = executor.submit(download_segment_idm, CACHE_FOLDER, url, order, name_prefix)
-                else:
-                    future = executor.submit(download_segment, CACHE_FOLDER, url, order, name_prefix)
-
-                # Store the future and order for tracking
-                future_to_order[future] = order
-
-                # Add a 1-second interval between submissions
-                time.sleep(1)
-
-            # Iterate over the completed futures
-            for future in as_completed(future_to_order):
-                order = future_to_order[future]
-                try:
-                    result = future.result()  # Get the result (will raise exception if there was one)
-                    if not idm_flag and result != 0:
-                        print(f"Failed to download {name_prefix} - {order}, downloader returned {result}", file=sys.stderr)
-                        has_error = True
-                    else:
-                        print(f"Successfully downloaded {name_prefix} - {order}")
-                except Exception:
-                    print(traceback.format_exc())
-                    print(f"Failed to download {name_prefix} - {order}", file=sys.stderr)
-                    has_error = True
-
+        return list(lesson_video_data)
     # v1 type
     elif fallback_flag == 1:
-        # Create a ThreadPoolExecutor to manage parallel downloads
-        with ThreadPoolExecutor(max_workers=6) as executor:
-            # Dictionary to hold future results
-            future_to_order = {}
-
-            for order, segment in enumerate(lesson_video_data['data']['live_timeline']):
-                replay_url = segment['replay_url']
-
-                # Determine which function to use based on the presence of 'm3u8' in the replay_url
-                if 'm3u8' in replay_url:
-                    future = executor.submit(download_segment_m3u8, idm_flag, CACHE_FOLDER, replay_url, order,
-                                             name_prefix,
-                                             max_retries=10)
-                else:
-                    if idm_flag:
-                        future = executor.submit(download_segment_idm, CACHE_FOLDER, replay_url, order, name_prefix)
-                    else:
-                        future = executor.submit(download_segment, CACHE_FOLDER, replay_url, order, name_prefix)
-
-                # Store the future and order for tracking
-                future_to_order[future] = order
-
-                # Add a 1-second interval between submissions
-                time.sleep(1)
-
-            # Iterate over the completed futures
-            for future in as_completed(future_to_order):
-                order = future_to_order[future]
-                try:
-                    result = future.result()  # Get the result (will raise exception if there was one)
-                    if not idm_flag and result != 0:
-                        print(f"Failed to download {name_prefix} - {order}, downloader returned {result}", file=sys.stderr)
-                        has_error = True
-                    else:
-                        print(f"Successfully downloaded {name_prefix} - {order}")
-                except Exception:
-                    print(traceback.format_exc())
-                    print(f"Failed to download {name_prefix} - {order}", file=sys.stderr)
-                    has_error = True
-
+        return [segment['replay_url'] for segment in lesson_video_data['data']['live_timeline']]
     # v3 type
     else:
-        # Create a ThreadPoolExecutor to manage parallel downloads
-        with ThreadPoolExecutor(max_workers=6) as executor:
-            # Dictionary to hold future results
-            future_to_order = {}
-
-            for order, segment in enumerate(lesson_video_data['data']['live']):
-                url = segment['url']
-
-                # Determine which function to use based on the presence of 'm3u8' in the URL
-                if 'm3u8' in url:
-                    future = executor.submit(download_segment_m3u8, idm_flag, CACHE_FOLDER, url, order, name_prefix,
-                                             max_retries=10)
-                else:
-                    if idm_flag:
-                        future = executor.submit(download_segment_idm, CACHE_FOLDER, url, order, name_prefix)
-                    else:
-                        future = executor.submit(download_segment, CACHE_FOLDER, url, order, name_prefix)
-
-                # Store the future and order for tracking
-                future_to_order[future] = order
-
-                # Add a 1-second interval between submissions
-                time.sleep(1)
-
-            # Iterate over the completed futures
-            for future in as_completed(future_to_order):
-                order = future_to_order[future]
-                try:
-                    result = future.result()  # Get the result (will raise exception if there was one)
-                    if not idm_flag and result != 0:
-                        print(f"Failed to download {name_prefix} - {order}, downloader returned {result}", file=sys.stderr)
-                        has_error = True
-                    else:
-                        print(f"Successfully downloaded {name_prefix} - {order}")
-                except Exception:
-                    print(traceback.format_exc())
-                    print(f"Failed to download {name_prefix} - {order}", file=sys.stderr)
-                    has_error = True
+        return [segment['url'] for segment in lesson_video_data['data']['live']]
+
+
+def is_m3u8(fallback_flag, url: str) -> bool:
+    return fallback_flag != 2 and 'm3u8' in url
+
+
+def submit_segments(idm_flag, fallback_flag, CACHE_FOLDER, lesson_video_data, name_prefix, orders=None) -> Future:
+    """Queue the segments of a lesson, or only those in `orders`, on the segment scheduler"""
+    jobs = []
+
+    for order, url in enumerate(segment_urls(fallback_flag, lesson_video_data)):
+        if orders is not None and order not in orders:
+            continue
+
+        # Determine which function to use based on the presence of 'm3u8' in the URL
+        if is_m3u8(fallback_flag, url):
+            # HLS downloads retry each request themselves, retrying the whole stream on top would multiply that
+            jobs.append((order, download_segment_m3u8, (idm_flag, CACHE_FOLDER, url, order, name_prefix),
+                         {'max_retries': 10}))
+        elif idm_flag:
+            jobs.append((order, download_segment_idm, (CACHE_FOLDER, url, order, name_prefix), {}))
+        else:
+            jobs.append((order, retry_segment, (f"{name_prefix} - {order}", download_segment, CACHE_FOLDER, url,
+                                                order, name_prefix), {}))
+
+    return get_scheduler().submit_lesson(jobs)
+
+
+def check_segments(idm_flag, results: dict, name_prefix):
+    has_error = False
+
+    for order, result in results.items():
+        if isinstance(result, Exception):
+            print(f"Failed to download {name_prefix} - {order}", file=sys.stderr)
+            has_error = True
+        elif not idm_flag and result != 0:
+            print(f"Failed to download {name_prefix} - {order}, downloader returned {result}", file=sys.stderr)
+            has_error = True
+        else:
+            print(f"Successfully downloaded {name_prefix} - {order}")
 
     if has_error:
         raise Exception("Failed to download some video segments.")
 
 
-def concatenate_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix, num_segments):
-    # Create the concat file with segment paths
-    with open(f"{CACHE_FOLDER}/concat.txt", "w", encoding='utf-8') as f:
-        for i in range(num_segments):
-            video_file_mp4 = f"../{CACHE_FOLDER}/{name_prefix}-{i}.mp4"
-            video_file_ts = f"../{CACHE_FOLDER}/{name_prefix}-{i}.ts"
-            if os.path.exists(os.path.join(CACHE_FOLDER, f"{name_prefix}-{i}.mp4")):  # Check if the file exists
-                f.write(f"file '{video_file_mp4}'\n")
-            if os.path.exists(os.path.join(CACHE_FOLDER, f"{name_prefix}-{i}.ts")):  # Check if the file exists
-                f.write(f"file '{video_file_ts}'\n")
+def download_segments_in_parallel(idm_flag, fallback_flag, CACHE_FOLDER, lesson_video_data, name_prefix):
+    lesson_future = submit_segments(idm_flag, fallback_flag, CACHE_FOLDER, lesson_video_data, name_prefix)
+    check_segments(idm_flag, lesson_future.result(), name_prefix)
+
+
+def content_length(url: str):
+    try:
+        response = verify_session.head(url, allow_redirects=True)
+        response.raise_for_status()
+        return int(response.headers['Content-Length'])
+    except (requests.RequestException, KeyError, ValueError):
+        return None
+
+
+def verify_segment(CACHE_FOLDER, url: str, order: int, name_prefix: str, check_length: bool) -> str | None:
+    """Why a downloaded segment is unusable, or None if it looks complete"""
+    paths = [os.path.join(CACHE_FOLDER, f"{name_prefix}-{order}.{extension}") for extension in ("mp4", "ts")]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return "missing"
+
+    path = paths[0]
+    size = os.path.getsize(path)
+
+    # Servers that don't report a length can't be checked this way, ffprobe below still catches most damage
+    expected = content_length(url) if check_length else None
+    if expected is not None and size != expected:
+        return f"size {size} does not match Content-Length {expected}"
+
+    try:
+        result = subprocess.run([FFPROBE_PATH, "-v", "error", "-show_entries",
+                                 "format=duration:stream=codec_type,duration", "-of", "json", path],
+                                capture_output=True, text=True)
+    except FileNotFoundError:
+        # Without ffprobe only the size can be checked
+        return None
+
+    if result.returncode != 0:
+        return f"ffprobe failed: {result.stderr.strip()}"
+
+    info = json.loads(result.stdout)
+    streams = {}
+    for stream in info.get('streams', []):
+        streams.setdefault(stream.get('codec_type'), stream)
+
+    # Voice-only replays have no video stream, so the audio stream stands in for it
+    stream = streams.get('video') or streams.get('audio')
+    if stream is None:
+        return "no audio or video stream"
+
+    # Not every container stores a duration per stream
+    duration = stream.get('duration')
+    if duration in (None, "N/A"):
+        duration = info.get('format', {}).get('duration')
+    try:
+        if float(duration) <= 0:
+            return f"zero {stream['codec_type']} duration"
+    except (TypeError, ValueError):
+        return "unknown duration"
+
+    return None
+
+
+def verify_segments(fallback_flag, CACHE_FOLDER, lesson_video_data, name_prefix) -> list:
+    """Check the downloaded segments of a lesson and return the orders of the broken ones"""
+    urls = segment_urls(fallback_flag, lesson_video_data)
+
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as pool:
+        problems = list(pool.map(lambda item: verify_segment(CACHE_FOLDER, item[1], item[0], name_prefix,
+                                                             not is_m3u8(fallback_flag, item[1])),
+                                 enumerate(urls)))
+
+    broken = []
+    for order, problem in enumerate(problems):
+        if problem is not None:
+            print(f"Segment {name_prefix} - {order} is broken: {problem}", file=sys.stderr)
+            broken.append(order)
+
+    return broken
+
+
+def remove_segment(CACHE_FOLDER, order: int, name_prefix: str):
+    # The aria2c control file would make it resume into the damaged file instead of starting over
+    for extension in ("mp4", "ts", "mp4.aria2", "ts.aria2"):
+        path = os.path.join(CACHE_FOLDER, f"{name_prefix}-{order}.{extension}")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def verify_and_repair_segments(idm_flag, fallback_flag, CACHE_FOLDER, lesson_video_data, name_prefix,
+                               max_refetches: int = 2):
+    """Verify all segments of a lesson and re-fetch only the broken ones until they are all good"""
+    for attempt in range(max_refetches + 1):
+        broken = verify_segments(fallback_flag, CACHE_FOLDER, lesson_video_data, name_prefix)
+        if not broken:
+            return
+
+        if attempt == max_refetches:
+            break
+
+        print(f"Re-fetching {len(broken)} broken segments of {name_prefix}")
+        for order in broken:
+            remove_segment(CACHE_FOLDER, order, name_prefix)
+
+        results = submit_segments(idm_flag, fallback_flag, CACHE_FOLDER, lesson_video_data, name_prefix,
+                                  orders=broken).result()
+        check_segments(idm_flag, results, name_prefix)
+
+    raise Exception(f"Segments {broken} of {name_prefix} are still broken after {max_refetches} re-fetches.")
+
+
+def segment_files(CACHE_FOLDER, name_prefix, num_segments) -> list:
+    files = []
+    for i in range(num_segments):
+        for extension in ("mp4", "ts"):
+            path = os.path.join(CACHE_FOLDER, f"{name_prefix}-{i}.{extension}")
+            if os.path.exists(path):  # Check if the file exists
+                files.append(path)
+                break
+        else:
+            print(f"Segment {name_prefix} - {i} is missing", file=sys.stderr)
+
+    return files
+
+
+def write_concat_file(CACHE_FOLDER, files: list, remote: bool = False) -> str:
+    # Unique to each job so that several concatenations can run at once
+    fd, concat_file = tempfile.mkstemp(prefix="concat-", suffix=".txt", dir=CACHE_FOLDER)
+    with os.fdopen(fd, "w", encoding='utf-8') as f:
+        for path in files:
+            path = path.replace("'", "'\\''")
+            # Local entries are relative to the concat file, which lives in the cache folder
+            f.write(f"file '{path}'\n" if remote else f"file '../{path}'\n")
+
+    return concat_file
 
+
+def probe_segment(path: str):
+    """The stream parameters that must match for segments to be joined without re-encoding, or None"""
+    result = subprocess.run([FFPROBE_PATH, "-v", "error", "-show_entries",
+                             "stream=codec_type,codec_name,width,height,pix_fmt,time_base,sample_rate,channels",
+                             "-of", "json", path], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+
+    streams = json.loads(result.stdout).get('streams', [])
+    return tuple(sorted(tuple(sorted((k, str(v)) for k, v in stream.items() if k != 'index'))
+                        for stream in streams if stream.get('codec_type') in ('video', 'audio')))
+
+
+def normalize_segment(path: str, reference: tuple, extension: str):
+    """Transcode a segment to the codec, resolution and timebase of `reference`, None if that is not possible"""
+    streams = [dict(stream) for stream in reference]
+    video = [stream for stream in streams if stream['codec_type'] == 'video']
+    audio = [stream for stream in streams if stream['codec_type'] == 'audio']
+
+    if len(video) != 1 or len(audio) > 1 or video[0]['codec_name'] not in SEGMENT_ENCODERS:
+        return None
+
+    video = video[0]
+    output_path = f"{os.path.splitext(path)[0]}.normalized{extension}"
+
+    command = [FFMPEG_PATH, "-i", path, "-map", "0:v:0",
+               "-c:v", SEGMENT_ENCODERS[video['codec_name']], "-vf", f"scale={video['width']}:{video['height']}",
+               "-pix_fmt", video['pix_fmt']]
+
+    if extension == ".mp4":
+        command += ["-video_track_timescale", video['time_base'].split("/")[1]]
+
+    if audio:
+        command += ["-map", "0:a:0", "-c:a", "aac", "-ar", audio[0]['sample_rate'], "-ac", audio[0]['channels']]
+
+    command += ["-y", "-hide_banner", "-loglevel", "error", output_path]
+
+    if subprocess.run(command).returncode != 0:
+        return None
+
+    # The audio stream of the source may be missing, which still leaves the segment incompatible
+    if probe_segment(output_path) != reference:
+        os.remove(output_path)
+        return None
+
+    return output_path
+
+
+def copy_concat(CACHE_FOLDER, files: list, target_file: str, concat_mode: str, remote: bool = False) -> bool:
+    """Join segments with the concat demuxer without re-encoding, True on success.
+
+    All segments must share codec, resolution and timebase. In `auto` mode segments that differ from the most
+    common parameters are transcoded to match first (not for `remote` URLs); otherwise, and whenever that
+    fails, nothing is written.
+    """
+    signatures = [probe_segment(path) for path in files]
+    if not files or None in signatures:
+        print("Could not probe all segments, stream copy is not possible")
+        return False
+
+    reference = Counter(signatures).most_common(1)[0][0]
+    # Transcoded segments use the container of the reference, which determines the timebase of .ts files
+    extension = os.path.splitext(files[signatures.index(reference)])[1]
+    mismatching = [i for i, signature in enumerate(signatures) if signature != reference]
+
+    if mismatching and (concat_mode != "auto" or remote):
+        print(f"{len(mismatching)} segments differ in codec, resolution or timebase, stream copy is not possible")
+        return False
+
+    files = list(files)
+    normalized = []
+
+    try:
+        for i in mismatching:
+            print(f"Transcoding mismatching segment {files[i]}")
+            path = normalize_segment(files[i], reference, extension)
+            if path is None:
+                print(f"Could not transcode {files[i]} to match the other segments")
+                return False
+
+            files[i] = path
+            normalized.append(path)
+
+        concat_file = write_concat_file(CACHE_FOLDER, files, remote)
+        try:
+            result = subprocess.run([FFMPEG_PATH] + (REMOTE_INPUT_ARGS if remote else [])
+                                    + ["-f", "concat", "-safe", "0", "-i", concat_file,
+                                       "-map", "0", "-c", "copy", "-movflags", "+faststart",
+                                       "-n", "-hide_banner", "-loglevel", "error", target_file])
+        finally:
+            os.remove(concat_file)
+    finally:
+        for path in normalized:
+            os.remove(path)
+
+    if result.returncode != 0:
+        if os.path.exists(target_file):
+            os.remove(target_file)
+        return False
+
+    return True
+
+
+def concatenate_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix, num_segments, concat_mode="encode"):
     target_file = os.path.join(DOWNLOAD_FOLDER, f"{name_prefix}.mp4")
     if os.path.exists(target_file):
         print(f"Skipping '{DOWNLOAD_FOLDER}/{name_prefix}.mp4' - Video already present")
-        time.sleep(0.25)
         return target_file
 
-    # First video concatenation command using CUDA acceleration
+    files = segment_files(CACHE_FOLDER, name_prefix, num_segments)
+    return join_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix, files, target_file, concat_mode)
+
+
+def stream_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, fallback_flag, lesson_video_data, name_prefix, concat_mode="encode"):
+    """Produce the final video straight from the segment URLs without keeping raw segments on disk"""
+    target_file = os.path.join(DOWNLOAD_FOLDER, f"{name_prefix}.mp4")
+    if os.path.exists(target_file):
+        print(f"Skipping '{DOWNLOAD_FOLDER}/{name_prefix}.mp4' - Video already present")
+        return target_file
+
+    print(f"Streaming {name_prefix}")
+    urls = segment_urls(fallback_flag, lesson_video_data)
+    return join_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix, urls, target_file, concat_mode, remote=True)
+
+
+def join_segments(CACHE_FOLDER, DOWNLOAD_FOLDER, name_prefix, files: list, target_file, concat_mode, remote=False):
+    if concat_mode != "encode":
+        if copy_concat(CACHE_FOLDER, files, target_file, concat_mode, remote):
+            print(f"Successfully concatenated video segments without re-encoding.")
+            return target_file
+
+        print(f"Falling back to re-encoding {name_prefix}")
+
+    concat_file = write_concat_file(CACHE_FOLDER, files, remote)
+
+    try:
+        return encode_concat_file(concat_file, DOWNLOAD_FOLDER, name_prefix, target_file, remote)
+    finally:
+        os.remove(concat_file)
+
+
+def probe_concat(concat_file: str):
+    """Total duration in seconds and whether there is an audio stream, or None if the list cannot be probed"""
+    result = subprocess.run([FFPROBE_PATH, "-v", "error", "-f", "concat", "-safe", "0", "-i", concat_file,
+                             "-show_entries", "format=duration:stream=codec_type", "-of", "json"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+
+    info = json.loads(result.stdout)
+    try:
+        duration = float(info['format']['duration'])
+    except (KeyError, ValueError):
+        return None
+
+    return duration, any(stream.get('codec_type') == 'audio' for stream in info.get('streams', []))
+
+
+def write_chunk_list(path: str, files: list):
+    with open(path, "w", encoding='utf-8') as f:
+        for file in files:
+            f.write(f"file '{os.path.abspath(file)}'\n")
+
+
+def encode_chunked(concat_file, target_file, chunks: int) -> bool:
+    """Encode a concat list as `chunks` pieces in parallel ffmpeg processes, True on success.
+
+    The video is split at keyframes without re-encoding, every piece is encoded on its own and the results are
+    stitched back with the concat demuxer. Audio is encoded once over the whole timeline so that no encoder
+    priming gaps end up at the chunk boundaries.
+    """
+    probe = probe_concat(concat_file)
+    if probe is None:
+        print("Could not probe the segments, chunked encoding is not possible")
+        return False
+
+    duration, has_audio = probe
+    work_dir = tempfile.mkdtemp(prefix="chunks-", dir=os.path.dirname(concat_file))
+
+    try:
+        split = subprocess.run([FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+                                "-f", "concat", "-safe", "0", "-i", concat_file, "-map", "0:v:0", "-c", "copy",
+                                "-f", "segment", "-segment_time", f"{duration / chunks:.3f}", "-reset_timestamps", "1",
+                                os.path.join(work_dir, "source-%04d.mkv")])
+        if split.returncode != 0:
+            return False
+
+        sources = sorted(name for name in os.listdir(work_dir) if name.startswith("source-"))
+        commands = []
+        for source in sources:
+            commands.append([FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-i", os.path.join(work_dir, source)]
+                            + encoders.get_video_args(encoders.get_chunk_threads())
+                            + ["-an", os.path.join(work_dir, source.replace("source-", "encoded-"))])
+
+        audio_file = os.path.join(work_dir, "audio.m4a")
+        if has_audio:
+            commands.append([FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+                             "-f", "concat", "-safe", "0", "-i", concat_file, "-map", "0:a:0",
+                             "-c:a", "aac", "-ac", "1", "-rematrix_maxval", "1.0", "-b:a", "64k", audio_file])
+
+        print(f"Encoding {len(sources)} chunks in parallel")
+        with ThreadPoolExecutor(max_workers=len(commands)) as pool:
+            results = list(pool.map(subprocess.run, commands))
+
+        if any(result.returncode != 0 for result in results):
+            return False
+
+        chunk_list = os.path.join(work_dir, "chunks.txt")
+        write_chunk_list(chunk_list, [os.path.join(work_dir, source.replace("source-", "encoded-"))
+                                      for source in sources])
+
+        stitch_command = [FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+                          "-f", "concat", "-safe", "0", "-i", chunk_list]
+        if has_audio:
+            stitch_command += ["-i", audio_file, "-map", "0:v:0", "-map", "1:a:0"]
+        stitch_command += ["-c", "copy", "-movflags", "+faststart", "-n", target_file]
+
+        if subprocess.run(stitch_command).returncode != 0:
+            if os.path.exists(target_file):
+                os.remove(target_file)
+            return False
+
+        return True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def encode_concat_file(concat_file, DOWNLOAD_FOLDER, name_prefix, target_file, remote=False):
+    profile = encoders.get_profile()
+    if profile is None:
+        print(f"No video encoder available, cannot encode {name_prefix}", file=sys.stderr)
+        return None
+
+    # Splitting into chunks would write the raw video to disk, which streaming avoids
+    chunks = encoders.get_chunks()
+    if chunks > 1 and not remote:
+        if encode_chunked(concat_file, target_file, chunks):
+            print(f"Successfully concatenated video segments using {profile} in {chunks} chunks.")
+            return target_file
+
+        print(f"Chunked encoding failed, encoding {name_prefix} in a single process")
+
+    # First video concatenation command using the encoder detected at startup
     video_concatenating_command = (
-        f"{FFMPEG_PATH} -f concat -safe 0 "
-        f"-i '{CACHE_FOLDER}/concat.txt' "
-        f"-c:v av1_nvenc -cq 36 -g 200 -bf 7 -b_strategy 1 -sc_threshold 80 -me_range 16  "
-        f"-surfaces 64 -bufsize 12800k -refs 16 -r 7.5 -temporal-aq 1 -rc-lookahead 127 "
-        f"-c:a aac -ac 1 -rematrix_maxval 1.0 -b:a 64k '{DOWNLOAD_FOLDER}/{name_prefix}.mp4' -n "
-        f"-hide_banner -loglevel error -stats"
+        [FFMPEG_PATH] + (REMOTE_INPUT_ARGS if remote else [])
+        + ["-f", "concat", "-safe", "0", "-i", concat_file]
+        + encoders.get_video_args()
+        + ["-c:a", "aac", "-ac", "1", "-rematrix_maxval", "1.0", "-b:a", "64k", target_file, "-n",
+           "-hide_banner", "-loglevel", "error", "-stats"]
     )
 
     # Run the first command
-    if WINDOWS:
-        result = subprocess.run(['powershell', '-Command', video_concatenating_command], text=True)
-    else:
-        result = subprocess.run(video_concatenating_command, shell=True)
+    result = subprocess.run(video_concatenating_command)
+
+    # Skipping damaged packets of streamed input can't be told apart from a segment that stopped arriving, so a
+    # failed stream is not retried leniently: the result could be silently truncated
+    if result.returncode != 0 and remote:
+        print(f"Streaming {name_prefix} failed, it will be fetched again on the next run", file=sys.stderr)
+        if os.path.exists(target_file):
+            os.remove(target_file)
+        return None
 
     # If the first command fails, try the fallback
     if result.returncode != 0:
-        print(f"First attempt failed. Attempting fallback with software decoding.")
+        print(f"First attempt failed. Attempting fallback ignoring corrupt input.")
 
-        # Fallback video concatenation command using cuvid acceleration
+        # Fallback video concatenation command skipping damaged packets
         video_concatenating_command_fallback = (
-            f"{FFMPEG_PATH} -f concat -safe 0 "
-            f"-i '{CACHE_FOLDER}/concat.txt' "
-            f"-c:v av1_nvenc -cq 36 -g 200 -bf 7 -b_strategy 1 -sc_threshold 80 -me_range 16 "
-            f"-surfaces 64 -bufsize 12800k -refs 16 -r 7.5 -temporal-aq 1 -rc-lookahead 127 "
-            f"-c:a copy '{DOWNLOAD_FOLDER}/{name_prefix}.mp4' -y "
-            f"-hide_banner -loglevel error -stats -err_detect ignore_err -fflags +discardcorrupt"
+            [FFMPEG_PATH] + (REMOTE_INPUT_ARGS if remote else [])
+            + ["-err_detect", "ignore_err", "-fflags", "+discardcorrupt", "-f", "concat", "-safe", "0", "-i", concat_file]
+            + encoders.get_video_args()
+            + ["-c:a", "copy", target_file, "-y", "-hide_banner", "-loglevel", "error", "-stats"]
         )
 
         # Run the fallback command
-        if WINDOWS:
-            fallback_result = subprocess.run(['powershell', '-Command', video_concatenating_command_fallback], text=True)
-        else:
-            fallback_result = subprocess.run(video_concatenating_command_fallback, shell=True)
+        fallback_result = subprocess.run(video_concatenating_command_fallback)
 
         # Check if the fallback also fails
         if fallback_result.returncode != 0:
             print(f"Both attempts failed to concatenate video segments.")
+            return None
         else:
             print(f"Successfully concatenated video segments.")
     else:
-        print(f"Successfully concatenated video segments using CUDA acceleration.")
+        print(f"Successfully concatenated video segments using {profile}.")
 
-    return result
+    return target_file